@@ -0,0 +1,280 @@
+"""Офлайн-бенчмарк: синтетические апдейты через dp.feed_update без живого токена.
+
+    python bench.py --users 50 --latency 30
+    python bench.py --flows wizard,album --users 20 --rate-limit
+
+Bot работает поверх фейковой сессии: она записывает вызовы API и отвечает
+правдоподобными объектами с заданной задержкой. Для каждого сценария
+печатается updates/sec, p50/p99 обработки апдейта и вызовы API на сценарий.
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("BOT_TOKEN", "42:BENCH")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("CHAT_BY_ID", "-1001")
+os.environ.setdefault("CHAT_DE_ID", "-1002")
+os.environ.setdefault("CHAT_RU_ID", "-1003")
+
+# bot.db и bot.log бенчмарка — во временном каталоге, рабочие файлы не трогаем;
+# каталог удаляется в конце main()
+_WORKDIR = tempfile.TemporaryDirectory(prefix="bot-bench-")
+WORKDIR = _WORKDIR.name
+os.chdir(WORKDIR)
+
+import bot as app  # noqa: E402
+
+from aiogram import Bot  # noqa: E402
+from aiogram import methods as tg  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import (  # noqa: E402
+    CallbackQuery, Chat, Document, Message, MessageId, PhotoSize, Update, User,
+)
+
+_ids = itertools.count(10_000)
+
+
+def fake_message(chat_id: int, text=None) -> Message:
+    return Message(
+        message_id=next(_ids),
+        date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=chat_id, type="private" if chat_id > 0 else "channel"),
+        text=text,
+    )
+
+
+class FakeSession(BaseSession):
+    """Сессия без сети: записывает вызовы и отвечает через `latency` секунд."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.reports = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, tg.SendMessage) and method.text.startswith("Добавлен пост"):
+            self.reports += 1
+        if isinstance(method, tg.SendMediaGroup):
+            return [fake_message(method.chat_id) for _ in method.media]
+        if isinstance(method, tg.CopyMessages):
+            return [MessageId(message_id=next(_ids)) for _ in method.message_ids]
+        if isinstance(method, tg.GetUpdates):
+            return []
+        if isinstance(method, (tg.SendMessage, tg.SendDocument, tg.EditMessageText,
+                               tg.EditMessageCaption, tg.EditMessageMedia)):
+            return fake_message(getattr(method, "chat_id", None) or 1)
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+# ---------- Синтетические апдейты ----------
+_update_ids = itertools.count(1)
+
+
+def _user(uid: int) -> User:
+    return User(id=uid, is_bot=False, first_name="Bench", username=f"bench_{uid}")
+
+
+def u_text(uid: int, text: str) -> Update:
+    return Update(update_id=next(_update_ids), message=Message(
+        message_id=next(_ids), date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=uid, type="private"), from_user=_user(uid), text=text,
+    ))
+
+
+def u_photo(uid: int, n: int, media_group_id=None) -> Update:
+    return Update(update_id=next(_update_ids), message=Message(
+        message_id=next(_ids), date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=uid, type="private"), from_user=_user(uid), media_group_id=media_group_id,
+        photo=[PhotoSize(file_id=f"photo-{uid}-{n}", file_unique_id=f"u-{uid}-{n}", width=1280, height=960)],
+    ))
+
+
+def u_document(uid: int, n: int) -> Update:
+    return Update(update_id=next(_update_ids), message=Message(
+        message_id=next(_ids), date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=uid, type="private"), from_user=_user(uid),
+        document=Document(file_id=f"doc-{uid}-{n}", file_unique_id=f"d-{uid}-{n}"),
+    ))
+
+
+def u_callback(uid: int, data: str) -> Update:
+    return Update(update_id=next(_update_ids), callback_query=CallbackQuery(
+        id=str(next(_ids)), from_user=_user(uid), chat_instance=str(uid), data=data,
+        message=fake_message(uid, "kbd"),
+    ))
+
+
+def wizard_answers(uid: int) -> List[Update]:
+    # у каждого пользователя своя ссылка — иначе сработает защита от повторной публикации
+    answers = {"link": f"https://suchen.mobile.de/fahrzeuge/details.html?id={uid}{next(_ids)}"}
+    return [u_text(uid, answers.get(key, example)) for key, _, example in app.FIELDS]
+
+
+def ready_text() -> str:
+    return "Kia Sportage 2023\n" + "Отличное состояние. " * 40
+
+
+# Сценарий: (подготовка — не измеряется, шаги — измеряются, ждать альбомы, ждать публикацию)
+Flow = Tuple[Callable[[int], List[Update]], Callable[[int], List[Update]], bool, bool]
+
+FLOWS: Dict[str, Flow] = {
+    "new": (
+        lambda uid: [],
+        lambda uid: [u_text(uid, "/new"), u_callback(uid, "new:wizard")],
+        False, False,
+    ),
+    "wizard": (
+        lambda uid: [u_text(uid, "/new"), u_callback(uid, "new:wizard")],
+        wizard_answers,
+        False, False,
+    ),
+    "ready": (
+        lambda uid: [u_text(uid, "/new"), u_callback(uid, "new:ready")],
+        lambda uid: [u_text(uid, ready_text())],
+        False, False,
+    ),
+    "single_media": (
+        lambda uid: [u_text(uid, "/new"), u_callback(uid, "new:ready"), u_text(uid, ready_text())],
+        lambda uid: [u_photo(uid, 0), u_photo(uid, 1), u_document(uid, 2)],
+        False, False,
+    ),
+    "album": (
+        lambda uid: [u_text(uid, "/new"), u_callback(uid, "new:ready"), u_text(uid, ready_text())],
+        lambda uid: [u_photo(uid, i, media_group_id=f"album-{uid}") for i in range(10)],
+        True, False,
+    ),
+    "publish": (
+        lambda uid: [u_text(uid, "/new"), u_callback(uid, "new:wizard"), *wizard_answers(uid),
+                     u_photo(uid, 0), u_photo(uid, 1)],
+        lambda uid: [u_callback(uid, "act:publish")],
+        False, True,
+    ),
+}
+
+
+async def settle(session: FakeSession, albums: bool, reports: int, tasks: int, timeout: float = 30.0):
+    """Ждём фоновую работу сценария: сборку альбомов, отчёты о публикации, порождённые задачи."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        busy = (
+            (albums and app.MEDIA_GROUPS)
+            or app.PREVIEWS.pending
+            or session.reports < reports
+            or len(asyncio.all_tasks()) > tasks
+        )
+        if not busy:
+            return
+        await asyncio.sleep(0.01)
+    print(f"  ! settle timeout (media_groups={len(app.MEDIA_GROUPS)}, reports={session.reports}/{reports})")
+
+
+def pct(values: List[float], q: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def run_flow(bot: Bot, session: FakeSession, name: str, users: int, base_uid: int) -> dict:
+    prepare, steps, albums, publish = FLOWS[name]
+    uids = [base_uid + i for i in range(users)]
+    for uid in uids:
+        await app.db_allow(f"bench_{uid}")
+
+    async def feed_all(uid: int, updates: List[Update], lat: List[float]):
+        for u in updates:
+            t0 = time.perf_counter()
+            await app.dp.feed_update(bot, u)
+            lat.append(time.perf_counter() - t0)
+
+    tasks = len(asyncio.all_tasks())
+    await asyncio.gather(*(feed_all(uid, prepare(uid), []) for uid in uids))
+    await settle(session, albums=True, reports=session.reports, tasks=tasks)
+
+    session.calls.clear()
+    reports_before = session.reports
+    latencies: List[float] = []
+    planned = [steps(uid) for uid in uids]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(feed_all(uid, ups, latencies) for uid, ups in zip(uids, planned)))
+    handled = time.perf_counter() - t0
+    await settle(session, albums=albums, reports=reports_before + (users if publish else 0), tasks=tasks)
+    total = time.perf_counter() - t0
+
+    n_updates = sum(len(p) for p in planned)
+    return {
+        "flow": name,
+        "updates": n_updates,
+        "ups": n_updates / handled if handled else 0.0,
+        "p50": pct(latencies, 50) * 1000,
+        "p99": pct(latencies, 99) * 1000,
+        "wall": total,
+        "calls": sum(session.calls.values()) / users,
+        "by_method": {k: v / users for k, v in session.calls.most_common()},
+    }
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--flows", default=",".join(FLOWS), help="сценарии через запятую")
+    ap.add_argument("--users", type=int, default=20, help="сколько пользователей параллельно")
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа API, мс")
+    ap.add_argument("--rate-limit", action="store_true", help="включить RateLimiter (как в проде)")
+    args = ap.parse_args()
+
+    # события бота пишутся в bot.log во временном каталоге, консоль — только под отчёт
+    app._sh.setLevel(logging.WARNING)
+
+    session = FakeSession(latency=args.latency / 1000)
+    bot = Bot(app.BOT_TOKEN, session=session)
+    if args.rate_limit:
+        bot.session.middleware(app.RATE_LIMITER)
+    bot.session.middleware(app.API_METRICS)
+
+    await app.db_init()
+    await app.OUTBOX.start(bot)
+
+    print(f"users={args.users} latency={args.latency}ms rate_limit={args.rate_limit} workdir={WORKDIR}")
+    print(f"{'flow':<14}{'updates':>8}{'upd/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'wall s':>8}{'calls/flow':>12}")
+    try:
+        # прогрев: ленивые схемы pydantic/aiogram строятся на первом вызове
+        for i, name in enumerate(args.flows.split(",")):
+            await run_flow(bot, session, name.strip(), 1, base_uid=900_000 + 1_000 * i)
+        for i, name in enumerate(args.flows.split(",")):
+            r = await run_flow(bot, session, name.strip(), args.users, base_uid=100_000 * (i + 1))
+            print(f"{r['flow']:<14}{r['updates']:>8}{r['ups']:>10.0f}{r['p50']:>9.2f}{r['p99']:>9.2f}"
+                  f"{r['wall']:>8.2f}{r['calls']:>12.1f}")
+            print("    " + ", ".join(f"{k}={v:g}" for k, v in r["by_method"].items()))
+    finally:
+        await app.OUTBOX.stop()
+        await app.STATE.close()
+        await app.STORAGE.close()
+        app.stop_logging()
+        os.chdir(ROOT)
+        _WORKDIR.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
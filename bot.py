@@ -1,15 +1,45 @@
+import abc
 import asyncio
+import atexit
+import io
+import signal
+import string
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import queue
+import random
 import sqlite3
 import logging
+import heapq
+import itertools
 import json
-from logging.handlers import RotatingFileHandler
-from dataclasses import dataclass, field
-from typing import Dict, Optional, List, Tuple
-
-from aiogram import Bot, Dispatcher, F
+import time
+import uuid
+import urllib.parse
+import re
+import zoneinfo
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from dataclasses import dataclass, field, fields
+from typing import Any, Callable, Dict, Optional, List, Sequence, Tuple, Set
+
+# отсчёт для --check-startup: дальше идёт самый дорогой импорт (aiogram.types)
+_BOOT_T0 = time.perf_counter()
+
+import aiohttp
+from aiogram import Bot, Dispatcher, F, __version__ as AIOGRAM_VERSION
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramConflictError, TelegramRetryAfter
+from aiogram.methods import SendMediaGroup, CopyMessages, GetUpdates
 from aiogram.filters import Command
 from aiogram.types import (
-    Message, CallbackQuery,
+    Message, CallbackQuery, BufferedInputFile, User,
     InlineKeyboardMarkup, InlineKeyboardButton,
     InputMediaPhoto, InputMediaVideo, InputMediaDocument,
     BotCommand, BotCommandScopeDefault, BotCommandScopeChat,
@@ -25,6 +55,8 @@ def env_int(name: str, default: int = 0) -> int:
     return int(v)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+# Приём апдейтов: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
 ADMIN_ID = env_int("ADMIN_ID", 0)
 
 CHAT_BY_ID = env_int("CHAT_BY_ID", 0)
@@ -33,9 +65,146 @@ CHAT_RU_ID = env_int("CHAT_RU_ID", 0)
 
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 
+# Как часто сбрасывать изменённые черновики в SQLite (мс)
+DRAFT_FLUSH_MS = env_int("DRAFT_FLUSH_MS", 500)
+
+# Сколько одновременных отправок в один канал при публикации
+PUBLISH_PER_CHAT_CONCURRENCY = env_int("PUBLISH_PER_CHAT_CONCURRENCY", 1)
+
+# Правка/снятие опубликованного поста: сколько каналов обрабатывать одновременно
+POST_ACTION_CONCURRENCY = env_int("POST_ACTION_CONCURRENCY", 3)
+
+# Outbox публикаций: число воркеров, попыток на канал и базовая пауза backoff (сек)
+OUTBOX_WORKERS = env_int("OUTBOX_WORKERS", 4)
+OUTBOX_MAX_ATTEMPTS = env_int("OUTBOX_MAX_ATTEMPTS", 5)
+OUTBOX_BACKOFF = env_int("OUTBOX_BACKOFF", 2)
+# Аренда строки outbox на время отправки (сек): упавший экземпляр отпускает её по истечении
+OUTBOX_LEASE_SEC = env_int("OUTBOX_LEASE_SEC", 300)
+
+# Мягкая остановка (SIGTERM): сколько секунд даём доделать апдейты, альбомы и публикации
+SHUTDOWN_TIMEOUT = env_int("SHUTDOWN_TIMEOUT", 25)
+
+# Раздача поста по каналам: send — полная отправка в каждый канал;
+# copy — полная отправка в первый канал, в остальные copyMessages (откат на send при ошибке)
+PUBLISH_FANOUT = os.getenv("PUBLISH_FANOUT", "send").strip().lower()
+
+# /list: сколько username на странице; предел размера файла для импорта allowlist (байт)
+LIST_PAGE_SIZE = env_int("LIST_PAGE_SIZE", 50)
+ALLOWLIST_IMPORT_MAX_BYTES = env_int("ALLOWLIST_IMPORT_MAX_BYTES", 1_000_000)
+
+# Отложенная публикация: часовой пояс ввода времени ("" = системный), минимальный
+# интервал между запланированными постами (с) и горизонт планирования (дни)
+PUBLISH_TZ = os.getenv("PUBLISH_TZ", "")
+SCHEDULE_SLOT_SEC = env_int("SCHEDULE_SLOT_SEC", 60)
+SCHEDULE_MAX_DAYS = env_int("SCHEDULE_MAX_DAYS", 30)
+
+# Лимиты Bot API (token bucket): глобально, в личку и в группы/каналы
+RATE_GLOBAL_PER_SEC = env_int("RATE_GLOBAL_PER_SEC", 30)
+RATE_PRIVATE_PER_SEC = env_int("RATE_PRIVATE_PER_SEC", 1)
+RATE_PRIVATE_BURST = env_int("RATE_PRIVATE_BURST", 15)  # альбом + хвост + клавиатура без ожидания
+RATE_GROUP_PER_MIN = env_int("RATE_GROUP_PER_MIN", 20)
+RATE_MAX_RETRIES = env_int("RATE_MAX_RETRIES", 3)
+
+# HTTP к Bot API: два пула — long polling и отправка (публикации, предпросмотры).
+# Лимит соединений, keep-alive простаивающих соединений (с), TTL DNS-кэша (с), таймауты (с)
+HTTP_SEND_LIMIT = env_int("HTTP_SEND_LIMIT", 50)
+HTTP_POLL_LIMIT = env_int("HTTP_POLL_LIMIT", 2)
+HTTP_KEEPALIVE = env_int("HTTP_KEEPALIVE", 60)
+HTTP_DNS_TTL = env_int("HTTP_DNS_TTL", 300)
+HTTP_SEND_TIMEOUT = env_int("HTTP_SEND_TIMEOUT", 20)
+HTTP_POLL_TIMEOUT = env_int("HTTP_POLL_TIMEOUT", 60)  # весь запрос getUpdates, включая long poll
+
+# Сэмплирование частых событий лога: "text_in=0.1,media_album_piece=0.2"
+LOG_SAMPLE: Dict[str, float] = {
+    k.strip(): float(v)
+    for k, v in (x.split("=", 1) for x in os.getenv("LOG_SAMPLE", "").split(",") if "=" in x)
+}
+
+# Локальный Prometheus endpoint http://127.0.0.1:PORT/metrics (0 = выключен)
+METRICS_PORT = env_int("METRICS_PORT", 0)
+
+# Обработка апдейтов: одного пользователя — строго по очереди, разных — параллельно,
+# но не больше UPDATE_CONCURRENCY хендлеров сразу
+UPDATE_CONCURRENCY = env_int("UPDATE_CONCURRENCY", 64)
+# Повторное нажатие той же кнопки того же сообщения: пока первое в работе и ещё столько мс после — игнорируем
+CALLBACK_DEDUP_MS = env_int("CALLBACK_DEDUP_MS", 1500)
+
+# Бюджет рестарта до первого getUpdates для --check-startup (мс)
+STARTUP_BUDGET_MS = env_int("STARTUP_BUDGET_MS", 5000)
+
+# Сборка альбомов: тишина после последнего кусочка (адаптивная, мс) и жёсткий потолок
+ALBUM_QUIET_MS = env_int("ALBUM_QUIET_MS", 1000)
+ALBUM_QUIET_MIN_MS = env_int("ALBUM_QUIET_MIN_MS", 250)
+ALBUM_MAX_WAIT_MS = env_int("ALBUM_MAX_WAIT_MS", 3000)
+
+# Шаблоны постов: TEMPLATE_DIR/post.txt (общий) и post_<BY|DE|RU>.txt (на канал)
+TEMPLATE_DIR = os.getenv("TEMPLATE_DIR", "templates")
+
+# Окно тишины для предпросмотра после медиа (мс): серия фото -> один предпросмотр
+PREVIEW_DEBOUNCE_MS = env_int("PREVIEW_DEBOUNCE_MS", 700)
+
+# Хранилище состояния (черновики, ожидание админа): sqlite | memory | socket
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").strip().lower()
+STATE_SOCKET = os.getenv("STATE_SOCKET", "bot-state.sock")
+
+# Шардирование по user id: номер воркера и их число (выставляет `bot.py --workers N`)
+SHARD_INDEX = env_int("BOT_SHARD", 0)
+SHARD_COUNT = max(1, env_int("BOT_SHARDS", 1))
+
+# Кэш allowlist перечитывается с диска раз в N секунд (0 = только write-through).
+# В воркерах по умолчанию 5 с: /allow у админа выполняет только его шард.
+ALLOWLIST_TTL = env_int("ALLOWLIST_TTL", 5 if SHARD_COUNT > 1 else 0)
+
+# Webhook: публичный URL (https://bot.example.com), локальный адрес aiohttp и секрет
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = env_int("WEBHOOK_PORT", 8080)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN пуст. Проверь .env")
 
+if BOT_MODE not in ("polling", "webhook"):
+    raise RuntimeError(f"BOT_MODE={BOT_MODE!r}: ожидается polling или webhook")
+
+if PUBLISH_FANOUT not in ("send", "copy"):
+    raise RuntimeError(f"PUBLISH_FANOUT={PUBLISH_FANOUT!r}: ожидается send или copy")
+
+def _local_zone() -> Tuple[zoneinfo.ZoneInfo, str]:
+    """Часовой пояс системы с правилами перехода на летнее время (не фиксированный сдвиг).
+
+    TZ=":/path" или "/path" читается из файла, TZ=":Europe/Berlin" — как IANA-имя.
+    Если зону не определить (POSIX-строка в TZ, нет /etc/localtime) — UTC и текст
+    предупреждения вторым элементом; бот при этом стартует.
+    """
+    raw = os.getenv("TZ", "")
+    name = raw.removeprefix(":")
+    try:
+        if name.startswith("/"):
+            with open(name, "rb") as f:
+                return zoneinfo.ZoneInfo.from_file(f, key=name), ""
+        if name:
+            return zoneinfo.ZoneInfo(name), ""
+        with open("/etc/localtime", "rb") as f:
+            return zoneinfo.ZoneInfo.from_file(f, key="localtime"), ""
+    except (OSError, ValueError, zoneinfo.ZoneInfoNotFoundError) as e:
+        source = f"TZ={raw!r}" if raw else "/etc/localtime"
+        return zoneinfo.ZoneInfo("UTC"), f"{source}: часовой пояс не прочитан ({e!r}), время публикации — UTC; задайте PUBLISH_TZ"
+
+
+PUBLISH_ZONE_WARNING = ""
+if PUBLISH_TZ:
+    try:
+        PUBLISH_ZONE = zoneinfo.ZoneInfo(PUBLISH_TZ)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise RuntimeError(f"PUBLISH_TZ={PUBLISH_TZ!r}: неизвестный часовой пояс")
+else:
+    PUBLISH_ZONE, PUBLISH_ZONE_WARNING = _local_zone()
+
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise RuntimeError("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+
 
 
 # SQLite файл (права доступа сохраняются после рестарта)
@@ -45,6 +214,8 @@ DB_PATH = "bot.db"
 dp = Dispatcher()
 
 # ===================== LOGGING =====================
+# Хендлеры бота только кладут записи в очередь. Форматирование, json.dumps и
+# запись на диск/в консоль делает фоновый поток listener'а, пачками.
 logger = logging.getLogger("bot")
 logger.setLevel(logging.INFO)
 
@@ -53,13 +224,91 @@ _fmt = logging.Formatter(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-_sh = logging.StreamHandler()
+
+class _BatchFlush:
+    """flush() на каждую запись отключён — listener сбрасывает буфер раз на пачку."""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class _BatchStreamHandler(_BatchFlush, logging.StreamHandler):
+    pass
+
+
+class _BatchFileHandler(_BatchFlush, RotatingFileHandler):
+    pass
+
+
+class _LazyQueueHandler(QueueHandler):
+    """Кладёт запись в очередь как есть, без форматирования в потоке event loop."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _BatchQueueListener(QueueListener):
+    """Забирает из очереди всё, что накопилось (до batch_size), и пишет одной пачкой."""
+
+    batch_size = 500
+
+    def _monitor(self):
+        stop = False
+        while not stop:
+            record = self.dequeue(True)
+            if record is self._sentinel:
+                break
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.dequeue(False)
+                except queue.Empty:
+                    break
+                if record is self._sentinel:
+                    stop = True
+                    break
+                batch.append(record)
+            for record in batch:
+                self.handle(record)
+            for h in self.handlers:
+                h.flush_batch()
+
+
+_sh = _BatchStreamHandler()
 _sh.setFormatter(_fmt)
-logger.addHandler(_sh)
 
-_fh = RotatingFileHandler("bot.log", maxBytes=2_000_000, backupCount=5, encoding="utf-8")
+_fh = _BatchFileHandler("bot.log" if SHARD_COUNT == 1 else f"bot.shard{SHARD_INDEX}.log", maxBytes=2_000_000, backupCount=5, encoding="utf-8")
 _fh.setFormatter(_fmt)
-logger.addHandler(_fh)
+
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logger.addHandler(_LazyQueueHandler(_log_queue))
+
+_log_listener = _BatchQueueListener(_log_queue, _sh, _fh, respect_handler_level=True)
+_log_listener.start()
+
+
+def stop_logging():
+    """Дописать очередь логов на диск; повторный вызов (atexit) — no-op."""
+    if _log_listener._thread is not None:
+        _log_listener.stop()
+
+
+atexit.register(stop_logging)
+
+
+class _LazyJson:
+    """json.dumps откладывается до момента записи (в потоке listener'а)."""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def __str__(self) -> str:
+        return json.dumps(self.data, ensure_ascii=False, default=str)
 
 
 def user_repr(u) -> str:
@@ -71,6 +320,11 @@ def user_repr(u) -> str:
 
 
 def log_event(event: str, *, user=None, chat_id=None, message_id=None, **payload):
+    rate = LOG_SAMPLE.get(event)
+    if rate is not None and random.random() >= rate:
+        return
+    if not logger.isEnabledFor(logging.INFO):
+        return
     data = {
         "event": event,
         "user": user_repr(user),
@@ -78,7 +332,7 @@ def log_event(event: str, *, user=None, chat_id=None, message_id=None, **payload
         "message_id": message_id,
         **payload,
     }
-    logger.info(json.dumps(data, ensure_ascii=False))
+    logger.info("%s", _LazyJson(data))
 
 
 async def safe_answer(cb: CallbackQuery, text: str = "", alert: bool = False):
@@ -89,43 +343,926 @@ async def safe_answer(cb: CallbackQuery, text: str = "", alert: bool = False):
         pass
 
 
-# Черновики в памяти
-DRAFTS: Dict[int, "Draft"] = {}
-MEDIA_GROUPS: Dict[Tuple[int, str], List[Message]] = {}
+# ---------- Metrics ----------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, v)] += 1
+        self.count += 1
+        self.sum += v
+        self.max = max(self.max, v)
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе бакета."""
+        if not self.count:
+            return 0.0
+        rank, acc = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank:
+                return min(LATENCY_BUCKETS[i], self.max) if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+
+class Metrics:
+    """Счётчики, гистограммы задержек и gauges процесса. Всё в памяти, без зависимостей."""
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, str, str], float] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def observe(self, name: str, label: str, value: str, v: float):
+        key = (name, label, value)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        h.observe(v)
+
+    def inc(self, name: str, label: str = "", value: str = "", n: float = 1):
+        key = (name, label, value)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        self.gauges[name] = fn
+
+    def render_text(self) -> str:
+        lines = []
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"{name}: {fn():g}")
+        for (name, label, value), h in sorted(self.histograms.items()):
+            lines.append(
+                f"{name}[{value}]: n={h.count} "
+                f"p50={h.quantile(0.5) * 1000:.0f}ms p99={h.quantile(0.99) * 1000:.0f}ms "
+                f"max={h.max * 1000:.0f}ms"
+            )
+        for (name, label, value), n in sorted(self.counters.items()):
+            lines.append(f"{name}[{value}]: {n:g}" if value else f"{name}: {n:g}")
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        def lbl(label: str, value: str, extra: str = "") -> str:
+            parts = [f'{label}="{value}"'] if label else []
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        out = []
+        for name, fn in sorted(self.gauges.items()):
+            out += [f"# TYPE bot_{name} gauge", f"bot_{name} {fn():g}"]
+        for (name, label, value), n in sorted(self.counters.items()):
+            out.append(f"bot_{name}{lbl(label, value)} {n:g}")
+        for (name, label, value), h in sorted(self.histograms.items()):
+            acc = 0
+            for i, le in enumerate(LATENCY_BUCKETS):
+                acc += h.counts[i]
+                bucket = lbl(label, value, 'le="%s"' % le)
+                out.append(f"bot_{name}_bucket{bucket} {acc}")
+            bucket = lbl(label, value, 'le="+Inf"')
+            out.append(f"bot_{name}_bucket{bucket} {h.count}")
+            out.append(f"bot_{name}_sum{lbl(label, value)} {h.sum:.6f}")
+            out.append(f"bot_{name}_count{lbl(label, value)} {h.count}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+
+# Какой хендлер сейчас выполняется — чтобы считать вызовы API на действие пользователя
+CURRENT_HANDLER: contextvars.ContextVar[str] = contextvars.ContextVar("current_handler", default="background")
+
+
+def timed(op: str):
+    """Декоратор: задержка async-операции в op_latency_seconds{op=...}."""
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                METRICS.observe("op_latency_seconds", "op", op, time.perf_counter() - t0)
+
+        return wrapper
+
+    return deco
+
+
+async def handler_metrics_middleware(handler, event, data):
+    """Inner middleware: задержка и ошибки каждого хендлера."""
+    h = data.get("handler")
+    name = h.callback.__name__ if h else "unknown"
+    token = CURRENT_HANDLER.set(name)
+    t0 = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        METRICS.inc("handler_errors_total", "handler", name)
+        raise
+    finally:
+        METRICS.observe("handler_latency_seconds", "handler", name, time.perf_counter() - t0)
+        CURRENT_HANDLER.reset(token)
+
+
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+
+
+@dp.update.outer_middleware()
+async def update_age_middleware(handler, event, data):
+    """Возраст апдейта к моменту обработки (для сообщений — от message.date)."""
+    msg = event.message or event.edited_message
+    if msg is not None and msg.date:
+        METRICS.observe("update_age_seconds", "type", event.event_type, max(0.0, time.time() - msg.date.timestamp()))
+    METRICS.inc("updates_total", "type", event.event_type)
+    return await handler(event, data)
+
+
+# ---------- Per-user ordering ----------
+class UserLocks:
+    """Очередь апдейтов на пользователя: asyncio.Lock на uid, пока у него есть ждущие.
+
+    Lock отдаёт захват в порядке ожидания, поэтому апдейты одного пользователя
+    обрабатываются в порядке поступления. Запись удаляется, когда очередь пуста.
+    """
+
+    def __init__(self):
+        self._locks: Dict[int, Tuple[asyncio.Lock, List[int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, uid: int):
+        entry = self._locks.get(uid)
+        if entry is None:
+            entry = self._locks[uid] = (asyncio.Lock(), [0])
+        lock, waiters = entry
+        waiters[0] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            waiters[0] -= 1
+            if not waiters[0]:
+                del self._locks[uid]
+
+
+USER_LOCKS = UserLocks()
+UPDATE_SLOTS = asyncio.Semaphore(max(1, UPDATE_CONCURRENCY))
+_CALLBACKS_SEEN: Dict[Tuple[int, int, str], float] = {}  # ключ -> когда закончили (0 — ещё в работе)
+_updates_in_flight = 0
+
+METRICS.gauge("user_queues", lambda: len(USER_LOCKS))
+METRICS.gauge("updates_in_flight", lambda: _updates_in_flight)
+
+
+def user_lock(uid: int):
+    """Очередь пользователя для фоновых задач (сборка альбома, отложенный предпросмотр).
+
+    Не брать из хендлера: он уже выполняется под этой же блокировкой.
+    """
+    return USER_LOCKS.hold(uid)
+
+
+def _callback_duplicate(key: Tuple[int, int, str]) -> bool:
+    done_at = _CALLBACKS_SEEN.get(key)
+    if done_at is None:
+        return False
+    return done_at == 0 or time.monotonic() - done_at < CALLBACK_DEDUP_MS / 1000
+
+
+def _callback_done(key: Tuple[int, int, str]):
+    now = time.monotonic()
+    _CALLBACKS_SEEN[key] = now
+    if len(_CALLBACKS_SEEN) > 1000:
+        horizon = now - CALLBACK_DEDUP_MS / 1000
+        for k in [k for k, t in _CALLBACKS_SEEN.items() if t and t < horizon]:
+            del _CALLBACKS_SEEN[k]
+
+
+@dp.update.outer_middleware()
+async def ordering_middleware(handler, event, data):
+    """Апдейты одного пользователя — по очереди, всего — не больше UPDATE_CONCURRENCY.
+
+    Сначала очередь пользователя, потом общий слот: ждущие своей очереди слоты не занимают.
+    Повторные нажатия той же кнопки (двойной тап) отбрасываются.
+    """
+    global _updates_in_flight
+    u = data.get("event_from_user")
+    cb = event.callback_query
+    key = None
+    if u is not None and cb is not None:
+        key = (u.id, cb.message.message_id if cb.message else 0, cb.data or "")
+        if _callback_duplicate(key):
+            METRICS.inc("callbacks_dropped_total")
+            log_event("callback_duplicate", user=u, chat_id=u.id, cb_data=cb.data)
+            await safe_answer(cb)
+            return None
+        _CALLBACKS_SEEN[key] = 0.0
+
+    t0 = time.perf_counter()
+    try:
+        async with (USER_LOCKS.hold(u.id) if u is not None else contextlib.nullcontext()), UPDATE_SLOTS:
+            METRICS.observe("update_queue_wait_seconds", "type", event.event_type, time.perf_counter() - t0)
+            _updates_in_flight += 1
+            try:
+                return await handler(event, data)
+            finally:
+                _updates_in_flight -= 1
+    finally:
+        if key is not None:
+            _callback_done(key)
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Задержка, вызовы и ошибки Bot API по методам (внутри RateLimiter — без ожидания токенов)."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        METRICS.inc("api_calls_total", "method", name)
+        METRICS.inc("api_calls_by_handler_total", "handler", CURRENT_HANDLER.get())
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            METRICS.inc("api_errors_total", "method", name)
+            raise
+        finally:
+            METRICS.observe("api_latency_seconds", "method", name, time.perf_counter() - t0)
+
+
+API_METRICS = ApiMetrics()
+
+
+async def metrics_http_handler(request):
+    from aiohttp import web
+
+    return web.Response(text=METRICS.render_prometheus(), content_type="text/plain")
+
+
+async def start_metrics_server():
+    from aiohttp import web
+
+    # воркер i слушает METRICS_PORT + 1 + i, процесс приёма апдейтов — METRICS_PORT
+    port = METRICS_PORT + (SHARD_INDEX + 1 if SHARD_COUNT > 1 else 0)
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_http_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    log_event("metrics_server_started", port=port)
+    return runner
+
+
+# ---------- HTTP session ----------
+def _http_trace(pool: str) -> aiohttp.TraceConfig:
+    """Счётчики пула: новые/переиспользованные соединения и ожидание свободного слота."""
+    trace = aiohttp.TraceConfig()
+
+    async def on_create(session, ctx, params):
+        METRICS.inc("http_connections_created_total", "pool", pool)
+
+    async def on_reuse(session, ctx, params):
+        METRICS.inc("http_connections_reused_total", "pool", pool)
+
+    async def on_queued_start(session, ctx, params):
+        ctx.queued_at = time.perf_counter()
+
+    async def on_queued_end(session, ctx, params):
+        METRICS.observe("http_pool_wait_seconds", "pool", pool, time.perf_counter() - ctx.queued_at)
+
+    trace.on_connection_create_end.append(on_create)
+    trace.on_connection_reuseconn.append(on_reuse)
+    trace.on_connection_queued_start.append(on_queued_start)
+    trace.on_connection_queued_end.append(on_queued_end)
+    return trace
+
+
+class PoolSession(AiohttpSession):
+    """AiohttpSession со своим пулом: лимит соединений, keep-alive, DNS-кэш и trace-счётчики.
+
+    Опирается на приватные поля AiohttpSession (_connector_init, _connector_type,
+    _should_reset_connector) — при обновлении aiogram (requirements.txt) проверить.
+    """
+
+    def __init__(self, pool: str, limit: int, timeout: float):
+        super().__init__(limit=limit, timeout=timeout)
+        self.pool = pool
+        self._connector_init.update(
+            limit_per_host=limit,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_TTL,
+        )
+
+    async def create_session(self) -> aiohttp.ClientSession:
+        if self._should_reset_connector:
+            await self.close()
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=self._connector_type(**self._connector_init),
+                headers={aiohttp.hdrs.USER_AGENT: f"{aiohttp.http.SERVER_SOFTWARE} aiogram/{AIOGRAM_VERSION}"},
+                trace_configs=[_http_trace(self.pool)],
+            )
+            self._should_reset_connector = False
+        return self._session
+
+
+class SplitSession(BaseSession):
+    """Сессия бота: getUpdates — в пул "poll", остальные методы — в пул "send".
+
+    Долгий getUpdates не занимает соединения публикаций и предпросмотров.
+    Request-middleware (RateLimiter, ApiMetrics) вешаются на эту сессию.
+    """
+
+    def __init__(self):
+        super().__init__(timeout=HTTP_SEND_TIMEOUT)
+        self.poll = PoolSession("poll", HTTP_POLL_LIMIT, HTTP_POLL_TIMEOUT)
+        self.send = PoolSession("send", HTTP_SEND_LIMIT, HTTP_SEND_TIMEOUT)
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, GetUpdates):
+            # dispatcher передаёт session.timeout + polling_timeout (таймаут пула send) —
+            # для getUpdates действует HTTP_POLL_TIMEOUT, но не меньше самого long poll
+            timeout = max(self.poll.timeout, (method.timeout or 0) + 5)
+            return await self.poll.make_request(bot, method, timeout=timeout)
+        return await self.send.make_request(bot, method, timeout=timeout)
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        async for chunk in self.send.stream_content(url, headers, timeout, chunk_size, raise_for_status):
+            yield chunk
+
+    async def close(self):
+        await self.poll.close()
+        await self.send.close()
+
+
+# Сборка альбомов живёт в памяти воркера: все кусочки альбома приходят от одного
+# пользователя, а шардирование по user id держит его апдейты в одном процессе.
+MEDIA_GROUPS: Dict[Tuple[int, str], "AlbumBuffer"] = {}
+
+
+# ---------- SQLite storage ----------
+class Storage:
+    """Одно долгоживущее соединение SQLite на выделенном потоке.
+
+    Все запросы уходят в executor с единственным воркером: соединение живёт
+    в одном потоке, а event loop никогда не ждёт диск/fsync.
+    Скомпилированные запросы переиспользуются через кэш statement'ов sqlite3
+    (поэтому SQL держим в константах, а не собираем строками).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._con: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _open(self):
+        con = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA busy_timeout=5000")
+        self._con = con
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def open(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        if self._con is None:
+            await self.run(self._open)
+
+    async def close(self):
+        if self._executor is None:
+            return
+        if self._con is not None:
+            await self.run(self._con.close)
+            self._con = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._con:
+            return self._con.execute(sql, params).rowcount
+
+    def _executemany(self, sql: str, rows: list) -> int:
+        with self._con:
+            return self._con.executemany(sql, rows).rowcount
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        return self._con.execute(sql, params).fetchall()
+
+    def _transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        with self._con:
+            return fn(self._con)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        return await self.run(self._execute, sql, params)
+
+    async def executemany(self, sql: str, rows: list) -> int:
+        return await self.run(self._executemany, sql, rows)
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await self.run(self._fetchall, sql, params)
+
+    async def transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполнить fn(con) в одной транзакции на потоке БД."""
+        return await self.run(self._transaction, fn)
 
-# Админский flow: /allow или /deny без аргумента -> ждём username следующим сообщением
-ADMIN_PENDING: Dict[int, str] = {}  # admin_id -> "allow" | "deny"
 
+STORAGE = Storage(DB_PATH)
 
-# ---------- SQLite (persist allowed usernames) ----------
-def db_init():
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute("CREATE TABLE IF NOT EXISTS allowed (username TEXT PRIMARY KEY)")
-        con.commit()
+# Служебные значения key -> value (например, хэш зарегистрированных команд)
+SQL_META_CREATE = "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+SQL_META_GET = "SELECT value FROM meta WHERE key=?"
+SQL_META_SET = "INSERT INTO meta(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value"
 
 
-def db_allow(username: str):
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute("INSERT OR IGNORE INTO allowed(username) VALUES(?)", (username,))
-        con.commit()
+async def db_meta_get(key: str) -> Optional[str]:
+    rows = await STORAGE.fetchall(SQL_META_GET, (key,))
+    return rows[0][0] if rows else None
 
 
-def db_deny(username: str):
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute("DELETE FROM allowed WHERE username=?", (username,))
-        con.commit()
+async def db_meta_set(key: str, value: str):
+    await STORAGE.execute(SQL_META_SET, (key, value))
 
 
-def db_list_allowed() -> List[str]:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.execute("SELECT username FROM allowed ORDER BY username")
-        return [r[0] for r in cur.fetchall()]
+# Доступ — по числовому Telegram id. username, выданные админом до первого контакта,
+# ждут в allowed_pending; usernames — индекс username -> id, пополняется на каждом контакте.
+SQL_ALLOWED_CREATE = "CREATE TABLE IF NOT EXISTS allowed (user_id INTEGER PRIMARY KEY, username TEXT)"
+SQL_ALLOWED_PENDING_CREATE = "CREATE TABLE IF NOT EXISTS allowed_pending (username TEXT PRIMARY KEY)"
+SQL_USERNAMES_CREATE = (
+    "CREATE TABLE IF NOT EXISTS usernames ("
+    "username TEXT PRIMARY KEY, user_id INTEGER NOT NULL, seen_at REAL NOT NULL)"
+)
+SQL_ALLOWED_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS allowed_username ON allowed(username)",
+)
+SQL_ALLOWED_INSERT = "INSERT OR IGNORE INTO allowed(user_id, username) VALUES(?, ?)"
+SQL_ALLOWED_RENAME = "UPDATE allowed SET username=? WHERE user_id=?"
+SQL_ALLOWED_DELETE = "DELETE FROM allowed WHERE user_id=?"
+SQL_ALLOWED_BY_NAME = "SELECT user_id FROM allowed WHERE username=?"
+SQL_ALLOWED_IDS = "SELECT user_id FROM allowed"
+SQL_ALLOWED_ALL = "SELECT user_id, username FROM allowed ORDER BY user_id"
+SQL_ALLOWED_COUNT = "SELECT COUNT(*) FROM allowed"
+# keyset-пагинация по INTEGER PRIMARY KEY: страница после/до известного id, без OFFSET
+SQL_ALLOWED_PAGE_AFTER = "SELECT user_id, username FROM allowed WHERE user_id > ? ORDER BY user_id LIMIT ?"
+SQL_ALLOWED_PAGE_BEFORE = "SELECT user_id, username FROM allowed WHERE user_id < ? ORDER BY user_id DESC LIMIT ?"
+SQL_PENDING_INSERT = "INSERT OR IGNORE INTO allowed_pending(username) VALUES(?)"
+SQL_PENDING_DELETE = "DELETE FROM allowed_pending WHERE username=?"
+SQL_PENDING_ALL = "SELECT username FROM allowed_pending ORDER BY username"
+SQL_USERNAME_RESOLVE = "SELECT user_id FROM usernames WHERE username=?"
+SQL_USERNAME_UPSERT = (
+    "INSERT INTO usernames(username, user_id, seen_at) VALUES(?, ?, ?) "
+    "ON CONFLICT(username) DO UPDATE SET user_id=excluded.user_id, seen_at=excluded.seen_at"
+)
+
+
+def _migrate_allowed_to_ids(con: sqlite3.Connection):
+    """v1: allowed(username TEXT PK) -> allowed(user_id INTEGER PK); старые username ждут первого контакта."""
+    if [r[1] for r in con.execute("PRAGMA table_info(allowed)")] != ["username"]:
+        return
+    con.execute("ALTER TABLE allowed RENAME TO allowed_v0")
+    con.execute(SQL_ALLOWED_CREATE)
+    con.execute(SQL_ALLOWED_PENDING_CREATE)
+    con.execute("INSERT OR IGNORE INTO allowed_pending(username) SELECT username FROM allowed_v0")
+    con.execute("DROP TABLE allowed_v0")
+
+
+def _add_columns(con: sqlite3.Connection, table: str, migrations: Dict[str, str]):
+    """ALTER TABLE ADD COLUMN для недостающих колонок. Таблицы ещё нет — её создаст db_init уже с ними."""
+    columns = {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+    if not columns:
+        return
+    for column, sql in migrations.items():
+        if column not in columns:
+            con.execute(sql)
+
+
+def _migrate_outbox_shard_source(con: sqlite3.Connection):
+    """v2: outbox.shard (воркер-владелец) и outbox.source_id (PUBLISH_FANOUT=copy)."""
+    _add_columns(con, "outbox", SQL_OUTBOX_MIGRATIONS)
+
+
+def _migrate_archive_retracted(con: sqlite3.Connection):
+    """v3: published_posts.retracted_at (снятие поста из каналов)."""
+    _add_columns(con, "published_posts", SQL_ARCHIVE_MIGRATIONS)
+
+
+def _migrate_outbox_lease(con: sqlite3.Connection):
+    """v4: outbox.lease_until — захват строки перед отправкой."""
+    _add_columns(con, "outbox", SQL_OUTBOX_LEASE_MIGRATIONS)
+
+
+def _migrate_archive_id(con: sqlite3.Connection):
+    """v5: published_posts.id INTEGER PRIMARY KEY как ключ published_fts.
+
+    Раньше FTS ссылался на неявный rowid таблицы с TEXT PRIMARY KEY — VACUUM
+    может его перенумеровать, и поиск молча вернёт чужие посты.
+    """
+    columns = [r[1] for r in con.execute("PRAGMA table_info(published_posts)")]
+    if not columns or "id" in columns:
+        return
+    con.execute("ALTER TABLE published_posts RENAME TO published_posts_v0")
+    con.execute(SQL_ARCHIVE_CREATE)
+    con.execute(
+        "INSERT INTO published_posts(post_id, author_id, created_at, text, draft, link_hash, retracted_at) "
+        "SELECT post_id, author_id, created_at, text, draft, link_hash, retracted_at "
+        "FROM published_posts_v0 ORDER BY rowid"
+    )
+    con.execute("DROP TABLE published_posts_v0")
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name='published_fts'").fetchone():
+        con.execute("DELETE FROM published_fts")
+        for row_id, text, draft in con.execute("SELECT id, text, draft FROM published_posts").fetchall():
+            con.execute(SQL_ARCHIVE_FTS_INSERT, (row_id, text, PostArchive._fts_data(draft_from_json(draft))))
+
+
+def _migrate_link_hash(con: sqlite3.Connection):
+    """v6: link_hash по новым правилам draft_link_hash (query у прочих сайтов, в готовом тексте — только площадки).
+
+    Ключ пересчитывается из сохранённого черновика; при совпадении ключ остаётся у более раннего поста.
+    """
+    if not con.execute("SELECT 1 FROM sqlite_master WHERE name='published_posts'").fetchone():
+        return
+    rows = con.execute("SELECT id, draft FROM published_posts WHERE link_hash IS NOT NULL ORDER BY id").fetchall()
+    con.execute("UPDATE published_posts SET link_hash=NULL")
+    for row_id, draft in rows:
+        link_hash = draft_link_hash(draft_from_json(draft))
+        if link_hash and not con.execute(SQL_ARCHIVE_BY_LINK, (link_hash,)).fetchone():
+            con.execute("UPDATE published_posts SET link_hash=? WHERE id=?", (link_hash, row_id))
+
+
+# Миграции схемы по PRAGMA user_version: i-я функция переводит базу с версии i на i+1.
+# Выполняются под BEGIN IMMEDIATE — воркеры `--workers N` не мигрируют одну базу наперегонки.
+SCHEMA_MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_allowed_to_ids,
+    _migrate_outbox_shard_source,
+    _migrate_archive_retracted,
+    _migrate_outbox_lease,
+    _migrate_archive_id,
+    _migrate_link_hash,
+]
+
+
+async def migrate_schema():
+    def tx(con: sqlite3.Connection):
+        con.execute("BEGIN IMMEDIATE")
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        for i in range(version, len(SCHEMA_MIGRATIONS)):
+            SCHEMA_MIGRATIONS[i](con)
+            log_event("schema_migrated", version=i + 1)
+        con.execute(f"PRAGMA user_version={max(version, len(SCHEMA_MIGRATIONS))}")
+
+    await STORAGE.transaction(tx)
+
+
+# ---------- State backends ----------
+class StateBackend(abc.ABC):
+    """Хранилище состояния пользователей: ns -> {uid: строка}.
+
+    Реализации: память процесса, SQLite (bot.db) и общий процесс-хранилище
+    по локальному сокету — для нескольких воркеров `bot.py --workers N`.
+    """
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    async def get(self, ns: str, uid: int) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    async def write(self, ns: str, upserts: List[Tuple[int, str]], deletes: List[int]):
+        ...
+
+
+class MemoryStateBackend(StateBackend):
+    def __init__(self):
+        self.data: Dict[str, Dict[int, str]] = {}
+
+    async def get(self, ns: str, uid: int) -> Optional[str]:
+        return self.data.get(ns, {}).get(uid)
+
+    async def write(self, ns: str, upserts: List[Tuple[int, str]], deletes: List[int]):
+        bucket = self.data.setdefault(ns, {})
+        bucket.update(upserts)
+        for uid in deletes:
+            bucket.pop(uid, None)
+
+
+class SqliteStateBackend(StateBackend):
+    """Таблица на пространство имён: (uid, payload, updated_at)."""
+
+    TABLES = {"drafts": "drafts", "admin_pending": "admin_pending"}
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self.sql = {
+            ns: {
+                "create": (
+                    f"CREATE TABLE IF NOT EXISTS {t} ("
+                    "uid INTEGER PRIMARY KEY, payload TEXT NOT NULL, updated_at REAL NOT NULL)"
+                ),
+                "get": f"SELECT payload FROM {t} WHERE uid=?",
+                "upsert": (
+                    f"INSERT INTO {t}(uid, payload, updated_at) VALUES(?, ?, ?) "
+                    "ON CONFLICT(uid) DO UPDATE SET payload=excluded.payload, updated_at=excluded.updated_at"
+                ),
+                "delete": f"DELETE FROM {t} WHERE uid=?",
+            }
+            for ns, t in self.TABLES.items()
+        }
+
+    async def open(self):
+        for q in self.sql.values():
+            await self.storage.execute(q["create"])
+
+    async def get(self, ns: str, uid: int) -> Optional[str]:
+        rows = await self.storage.fetchall(self.sql[ns]["get"], (uid,))
+        return rows[0][0] if rows else None
+
+    async def write(self, ns: str, upserts: List[Tuple[int, str]], deletes: List[int]):
+        q = self.sql[ns]
+        now = time.time()
+
+        def tx(con: sqlite3.Connection):
+            con.executemany(q["upsert"], [(uid, v, now) for uid, v in upserts])
+            con.executemany(q["delete"], [(uid,) for uid in deletes])
+
+        await self.storage.transaction(tx)
+
+
+class SocketStateBackend(StateBackend):
+    """Клиент общего хранилища (serve_state) по unix-сокету: JSON построчно, запрос-ответ."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def open(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def _call(self, req: dict) -> dict:
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self.open()
+                    self._writer.write(json.dumps(req, ensure_ascii=False).encode() + b"\n")
+                    await self._writer.drain()
+                    line = await self._reader.readline()
+                    if not line:
+                        raise ConnectionError("state server closed connection")
+                    return json.loads(line)
+                except (ConnectionError, OSError):
+                    await self.close()
+                    if attempt:
+                        raise
+
+    async def get(self, ns: str, uid: int) -> Optional[str]:
+        return (await self._call({"op": "get", "ns": ns, "uid": uid})).get("value")
+
+    async def write(self, ns: str, upserts: List[Tuple[int, str]], deletes: List[int]):
+        await self._call({"op": "write", "ns": ns, "upserts": upserts, "deletes": deletes})
+
+
+async def serve_state(path: str) -> asyncio.AbstractServer:
+    """Простое общее хранилище состояния в памяти на unix-сокете (замена Redis и т.п.)."""
+    backend = MemoryStateBackend()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                req = json.loads(line)
+                if req["op"] == "get":
+                    resp = {"value": await backend.get(req["ns"], req["uid"])}
+                else:
+                    await backend.write(req["ns"], [tuple(x) for x in req["upserts"]], req["deletes"])
+                    resp = {"ok": True}
+                writer.write(json.dumps(resp, ensure_ascii=False).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, json.JSONDecodeError, KeyError) as e:
+            logger.warning("state client dropped: %r", e)
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path=path)
+    log_event("state_server_started", path=path)
+    return server
+
+
+def make_state_backend() -> StateBackend:
+    if STATE_BACKEND == "memory":
+        return MemoryStateBackend()
+    if STATE_BACKEND == "socket":
+        return SocketStateBackend(STATE_SOCKET)
+    if STATE_BACKEND == "sqlite":
+        return SqliteStateBackend(STORAGE)
+    raise RuntimeError(f"STATE_BACKEND={STATE_BACKEND!r}: ожидается sqlite, memory или socket")
+
+
+STATE = make_state_backend()
+
+
+# ---------- Allowlist (persist allowed user ids) ----------
+# Кэш allowlist в памяти: грузится в db_init, обновляется write-through в db_allow/db_deny.
+# Проверка доступа — O(1) по числовому id, без похода в SQLite на каждом апдейте.
+ALLOWED_IDS: Set[int] = set()
+# username, которым админ выдал доступ, но бот ещё не видел их id
+ALLOWED_PENDING: Set[str] = set()
+# id -> username, уже записанный в индекс usernames этим процессом (самые старые вытесняются)
+_SEEN_USERNAMES: Dict[int, Optional[str]] = {}
+_SEEN_USERNAMES_MAX = 50_000
+_UNSEEN = object()
+
+
+def _set_allowed_cache(ids: Set[int], pending: Set[str]):
+    ALLOWED_IDS.clear()
+    ALLOWED_IDS.update(ids)
+    ALLOWED_PENDING.clear()
+    ALLOWED_PENDING.update(pending)
+
+
+async def _load_allowed_cache() -> Tuple[Set[int], Set[str]]:
+    ids = {r[0] for r in await STORAGE.fetchall(SQL_ALLOWED_IDS)}
+    pending = {r[0] for r in await STORAGE.fetchall(SQL_PENDING_ALL)}
+    return ids, pending
+
+
+async def db_init():
+    await STORAGE.open()
+    await migrate_schema()
+    await STORAGE.execute(SQL_META_CREATE)
+    for sql in (SQL_ALLOWED_CREATE, SQL_ALLOWED_PENDING_CREATE, SQL_USERNAMES_CREATE, *SQL_ALLOWED_INDEXES):
+        await STORAGE.execute(sql)
+    await STATE.open()
+    await STORAGE.execute(SQL_OUTBOX_CREATE)
+    for sql in SQL_OUTBOX_INDEXES:
+        await STORAGE.execute(sql)
+    await ARCHIVE.init()
+    _set_allowed_cache(*await _load_allowed_cache())
+
+
+async def db_allow_many(keys: List[str]) -> Tuple[int, int]:
+    """Выдать доступ пачке (username или числовых id) одной транзакцией.
+
+    username с известным id сразу превращается в id, остальные ждут первого контакта.
+    Возвращает (сколько добавлено, сколько из них ждут первого контакта).
+    """
+
+    def tx(con: sqlite3.Connection) -> Tuple[List[int], List[str], int]:
+        ids, pending, added = [], [], 0
+        for k in keys:
+            if k.isdigit():
+                uid, name = int(k), None
+            else:
+                row = con.execute(SQL_USERNAME_RESOLVE, (k,)).fetchone()
+                if row is None:
+                    added += con.execute(SQL_PENDING_INSERT, (k,)).rowcount
+                    pending.append(k)
+                    continue
+                uid, name = row[0], k
+            added += con.execute(SQL_ALLOWED_INSERT, (uid, name)).rowcount
+            if name:
+                con.execute(SQL_ALLOWED_RENAME, (name, uid))
+            ids.append(uid)
+        return ids, pending, added
+
+    ids, pending, added = await STORAGE.transaction(tx)
+    ALLOWED_IDS.update(ids)
+    ALLOWED_PENDING.update(pending)
+    return added, len(pending)
+
+
+async def db_deny_many(keys: List[str]) -> int:
+    """Забрать доступ пачке (username или id) одной транзакцией. Возвращает число снятых записей."""
+
+    def tx(con: sqlite3.Connection) -> Tuple[List[int], int]:
+        removed, n = [], 0
+        for k in keys:
+            if k.isdigit():
+                ids = [int(k)]
+            else:
+                n += con.execute(SQL_PENDING_DELETE, (k,)).rowcount
+                ids = [r[0] for r in con.execute(SQL_ALLOWED_BY_NAME, (k,))]
+                row = con.execute(SQL_USERNAME_RESOLVE, (k,)).fetchone()
+                if row and row[0] not in ids:
+                    ids.append(row[0])
+            for uid in ids:
+                n += con.execute(SQL_ALLOWED_DELETE, (uid,)).rowcount
+                removed.append(uid)
+        return removed, n
+
+    removed, n = await STORAGE.transaction(tx)
+    ALLOWED_IDS.difference_update(removed)
+    ALLOWED_PENDING.difference_update(k for k in keys if not k.isdigit())
+    return n
+
+
+async def db_allow(username: str):
+    await db_allow_many([username])
+
 
+async def db_deny(username: str):
+    await db_deny_many([username])
 
-def db_is_allowed(username: str) -> bool:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.execute("SELECT 1 FROM allowed WHERE username=? LIMIT 1", (username,))
-        return cur.fetchone() is not None
+
+async def db_list_allowed() -> Tuple[List[Tuple[int, Optional[str]]], List[str]]:
+    """(user_id, username) с доступом и username, ждущие первого контакта."""
+    rows = await STORAGE.fetchall(SQL_ALLOWED_ALL)
+    return [tuple(r) for r in rows], [r[0] for r in await STORAGE.fetchall(SQL_PENDING_ALL)]
+
+
+async def db_allowed_page(
+    after: int = 0, before: Optional[int] = None
+) -> Tuple[List[Tuple[int, Optional[str]]], bool, bool]:
+    """Страница allowlist по id: ((user_id, username), есть ли раньше, есть ли дальше)."""
+    n = max(1, LIST_PAGE_SIZE)
+    if before is not None:
+        rows = await STORAGE.fetchall(SQL_ALLOWED_PAGE_BEFORE, (before, n + 1))
+        items = [tuple(r) for r in rows[:n]][::-1]
+        return items, len(rows) > n, True
+    rows = await STORAGE.fetchall(SQL_ALLOWED_PAGE_AFTER, (after, n + 1))
+    return [tuple(r) for r in rows[:n]], bool(after), len(rows) > n
+
+
+async def db_is_allowed(user_id: int) -> bool:
+    return user_id in ALLOWED_IDS
+
+
+async def remember_user(user: User):
+    """Первый контакт пользователя в этом процессе: username -> id в индекс, выданный
+    по username доступ переводится на id. Дальше — только сравнение в памяти."""
+    name = user.username.lower() if user.username else None
+    # ALLOWED_PENDING в другом процессе отстаёт до ALLOWLIST_TTL: уже виденного
+    # пользователя всё равно переводим, когда выданный ему доступ дойдёт до кэша
+    promote = name in ALLOWED_PENDING
+    if not promote and _SEEN_USERNAMES.get(user.id, _UNSEEN) == name:
+        return
+    _SEEN_USERNAMES.pop(user.id, None)
+    _SEEN_USERNAMES[user.id] = name
+    if len(_SEEN_USERNAMES) > _SEEN_USERNAMES_MAX:
+        del _SEEN_USERNAMES[next(iter(_SEEN_USERNAMES))]
+    if name is None:
+        return
+
+    def tx(con: sqlite3.Connection):
+        con.execute(SQL_USERNAME_UPSERT, (name, user.id, time.time()))
+        con.execute(SQL_ALLOWED_RENAME, (name, user.id))
+        if promote:
+            con.execute(SQL_ALLOWED_INSERT, (user.id, name))
+            con.execute(SQL_PENDING_DELETE, (name,))
+
+    await STORAGE.transaction(tx)
+    if promote:
+        ALLOWED_IDS.add(user.id)
+        ALLOWED_PENDING.discard(name)
+        log_event("access_promoted", user=user, chat_id=user.id)
+
+
+@dp.update.outer_middleware()
+async def users_middleware(handler, event, data):
+    u = data.get("event_from_user")
+    if u and not u.is_bot:
+        await remember_user(u)
+    return await handler(event, data)
+
+
+async def allowlist_refresher():
+    """Периодически перечитывает allowlist с диска (правки в обход бота, другие процессы)."""
+    while True:
+        await asyncio.sleep(ALLOWLIST_TTL)
+        try:
+            ids, pending = await _load_allowed_cache()
+        except Exception as e:
+            logger.warning("allowlist refresh failed: %r", e)
+            continue
+        _set_allowed_cache(ids, pending)
+        log_event("allowlist_refreshed", size=len(ids), pending=len(pending))
 
 
 # ---------- Access helpers ----------
@@ -133,27 +1270,59 @@ def is_admin_id(user_id: int) -> bool:
     return user_id == ADMIN_ID and ADMIN_ID != 0
 
 
-def username_key(m: Message) -> Optional[str]:
-    u = m.from_user.username if m.from_user else None
-    return u.lower() if u else None
+_USERNAME_RE = re.compile(r"^[a-z][a-z0-9_]{3,31}$")
+_USER_ID_RE = re.compile(r"^[0-9]{1,20}$")
+
+
+def parse_usernames(tokens: List[str]) -> Tuple[List[str], List[str]]:
+    """@a, b, t.me/c, 12345 -> (корректные username/числовые id без дублей, отброшенные строки)."""
+    ok, bad, seen = [], [], set()
+    for raw in tokens:
+        u = raw.strip().strip(",;").removeprefix("https://").removeprefix("t.me/").lstrip("@").lower()
+        if not u or u in ("username", "user_id"):  # пустые ячейки и заголовок CSV
+            continue
+        if not (_USERNAME_RE.match(u) or _USER_ID_RE.match(u)):
+            bad.append(raw)
+        elif u not in seen:
+            seen.add(u)
+            ok.append(u)
+    return ok, bad
+
+
+def usernames_from_file(data: bytes) -> List[str]:
+    """Токены из CSV/TXT: все ячейки всех строк, внутри ячейки — через пробел.
+
+    Если в строке есть числовой id (формат /export: user_id,username), берём только его.
+    """
+    import csv
+
+    text = data.decode("utf-8-sig", errors="replace")
+    out = []
+    for row in csv.reader(io.StringIO(text)):
+        tokens = [tok for cell in row for tok in cell.split()]
+        ids = [tok for tok in tokens if _USER_ID_RE.match(tok)]
+        out += ids or tokens
+    return out
+
+
+def fmt_user_key(key: str) -> str:
+    return f"id {key}" if key.isdigit() else f"@{key}"
 
 
-def has_access_user_id(m: Message) -> bool:
+async def has_access_user_id(m: Message) -> bool:
     if not m.from_user:
         return False
     if is_admin_id(m.from_user.id):
         return True
-    u = username_key(m)
-    return bool(u and db_is_allowed(u))
+    return await db_is_allowed(m.from_user.id)
 
 
-def has_access_cb(cb: CallbackQuery) -> bool:
+async def has_access_cb(cb: CallbackQuery) -> bool:
     if not cb.from_user:
         return False
     if is_admin_id(cb.from_user.id):
         return True
-    u = (cb.from_user.username or "").lower()
-    return bool(u and db_is_allowed(u))
+    return await db_is_allowed(cb.from_user.id)
 
 
 async def deny_access_reply(m: Message):
@@ -164,14 +1333,143 @@ async def deny_access_reply(m: Message):
         message_id=m.message_id,
         text=(m.text or "")[:200],
     )
+    u = m.from_user
+    key = f"@{u.username}" if u and u.username else (str(u.id) if u else "@username")
     await m.answer(
         "⛔️ У вас нет доступа к созданию объявлений.\n"
         "Попросите администратора выдать доступ командой:\n"
-        "/allow @username\n\n"
-        "Важно: у вас должен быть установлен username в Telegram."
+        f"/allow {key}\n\n"
+        f"Ваш Telegram id: {u.id if u else '—'} (подойдёт, если нет username)."
     )
 
 
+# ---------- Rate limiting (Bot API) ----------
+PRIO_USER = 0  # личка: предпросмотр, ответы
+PRIO_BULK = 1  # каналы: публикация
+
+
+class TokenBucket:
+    """Token bucket с очередью ожидающих по приоритету (меньше — раньше)."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._stamp = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters: List[Tuple[int, int]] = []
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def pause(self, seconds: float):
+        """Flood wait: никто не получает токены раньше, чем через seconds."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, cost: float = 1.0, priority: int = PRIO_BULK):
+        cost = min(cost, self.capacity)
+        entry = (priority, next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self._cond.notify_all()
+            try:
+                while True:
+                    self._refill()
+                    timeout = None
+                    blocked = self._blocked_until - time.monotonic()
+                    if self._waiters[0] == entry:
+                        if blocked > 0:
+                            timeout = blocked
+                        elif self._tokens >= cost:
+                            heapq.heappop(self._waiters)
+                            self._tokens -= cost
+                            self._cond.notify_all()
+                            return
+                        else:
+                            timeout = (cost - self._tokens) / self.rate
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+
+class RateLimiter(BaseRequestMiddleware):
+    """Ограничитель для всех исходящих вызовов Bot API.
+
+    Глобальное ведро + ведро на каждый chat_id (личка и группы/каналы
+    с разными лимитами). Альбом стоит столько токенов, сколько в нём
+    элементов. Вызовы в личку обслуживаются раньше публикаций в каналы.
+    TelegramRetryAfter отрабатывается здесь же: ведро чата ставится на паузу,
+    запрос повторяется до RATE_MAX_RETRIES раз.
+    """
+
+    def __init__(self):
+        # глобальный лимит и лимиты каналов общие на все воркеры — делим поровну
+        rate = RATE_GLOBAL_PER_SEC / SHARD_COUNT
+        self.global_bucket = TokenBucket(rate, max(1, rate))
+        self._chats: Dict[Any, TokenBucket] = {}
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                b = TokenBucket(RATE_PRIVATE_PER_SEC, RATE_PRIVATE_BURST)
+            else:
+                rate = RATE_GROUP_PER_MIN / 60 / SHARD_COUNT
+                b = TokenBucket(rate, max(1, RATE_GROUP_PER_MIN // SHARD_COUNT))
+            self._chats[chat_id] = b
+        return b
+
+    @staticmethod
+    def cost(method) -> int:
+        if isinstance(method, SendMediaGroup):
+            return len(method.media)
+        if isinstance(method, CopyMessages):
+            return len(method.message_ids)
+        return 1
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:  # getUpdates, answerCallbackQuery, setMyCommands...
+            return await make_request(bot, method)
+
+        cost = self.cost(method)
+        priority = PRIO_USER if isinstance(chat_id, int) and chat_id > 0 else PRIO_BULK
+        bucket = self.chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            await bucket.acquire(cost, priority)
+            await self.global_bucket.acquire(cost, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                log_event(
+                    "rate_retry_after",
+                    chat_id=chat_id,
+                    method=type(method).__name__,
+                    retry_after=e.retry_after,
+                    attempt=attempt,
+                )
+                METRICS.inc("api_retries_total", "method", type(method).__name__)
+                if attempt > RATE_MAX_RETRIES:
+                    raise
+                bucket.pause(e.retry_after)
+
+
+RATE_LIMITER = RateLimiter()
+
+
 # ---------- Draft / Wizard ----------
 @dataclass
 class Draft:
@@ -184,6 +1482,118 @@ class Draft:
     finalized: bool = False
     awaiting_edit_field: Optional[str] = None
     awaiting_ready_text: bool = False
+    awaiting_schedule: bool = False
+    editing_post: str = ""  # post_id опубликованного поста, который правим
+    allow_duplicate: bool = False  # админ разрешил публикацию, хотя ссылка уже встречалась
+    version: int = 0  # растёт при каждом изменении текста поста
+    # показанный предпросмотр: id сообщений и что в них сейчас (для правки на месте)
+    preview: Dict[str, Any] = field(default_factory=dict)
+    # кэш рендера: код шаблона -> (version, текст); в БД не пишется
+    _rendered: Dict[str, Tuple[int, str]] = field(default_factory=dict, repr=False, compare=False)
+
+    def touch(self):
+        self.version += 1
+
+
+_DRAFT_FIELDS = [f.name for f in fields(Draft) if not f.name.startswith("_")]
+
+
+def draft_to_json(d: Draft) -> str:
+    return json.dumps({k: getattr(d, k) for k in _DRAFT_FIELDS}, ensure_ascii=False)
+
+
+def draft_from_json(raw: str) -> Draft:
+    payload = json.loads(raw)
+    return Draft(**{k: payload[k] for k in _DRAFT_FIELDS if k in payload})
+
+
+class WriteBehindStore(dict):
+    """Состояние пользователей в памяти с write-behind в STATE (пространство имён ns).
+
+    Значение подгружается на первом апдейте пользователя (load). Изменения не
+    пишутся сразу: uid попадает в _dirty, а flush раз в DRAFT_FLUSH_MS пишет всё
+    накопленное одним пакетом.
+    """
+
+    def __init__(self, ns: str, encode: Callable[[Any], str], decode: Callable[[str], Any]):
+        super().__init__()
+        self.ns = ns
+        self.encode = encode
+        self.decode = decode
+        self._loaded: Set[int] = set()
+        self._dirty: Set[int] = set()
+
+    def __setitem__(self, uid: int, value):
+        super().__setitem__(uid, value)
+        self._loaded.add(uid)
+        self._dirty.add(uid)
+
+    def pop(self, uid: int, default=None):
+        self._loaded.add(uid)
+        self._dirty.add(uid)
+        return super().pop(uid, default)
+
+    def mark_dirty(self, uid: int):
+        if uid in self:
+            self._dirty.add(uid)
+
+    async def load(self, uid: int):
+        if uid in self._loaded:
+            return
+        raw = await STATE.get(self.ns, uid)
+        if uid in self._loaded:  # пока читали, значение уже создали/загрузили
+            return
+        self._loaded.add(uid)
+        if raw is not None:
+            try:
+                super().__setitem__(uid, self.decode(raw))
+            except Exception as e:
+                logger.warning("%s load failed uid=%s: %r", self.ns, uid, e)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        uids, self._dirty = self._dirty, set()
+        upserts = [(uid, self.encode(self[uid])) for uid in uids if uid in self]
+        deletes = [uid for uid in uids if uid not in self]
+        try:
+            await STATE.write(self.ns, upserts, deletes)
+        except Exception as e:
+            self._dirty |= uids
+            logger.warning("%s flush failed: %r", self.ns, e)
+
+
+# Черновики: в памяти + STATE (переживают рестарт)
+DRAFTS = WriteBehindStore("drafts", draft_to_json, draft_from_json)
+
+# Админский flow: /allow или /deny без аргумента -> ждём username следующим сообщением
+ADMIN_PENDING = WriteBehindStore("admin_pending", str, str)  # admin_id -> "allow" | "deny"
+
+
+async def state_flusher():
+    while True:
+        await asyncio.sleep(DRAFT_FLUSH_MS / 1000)
+        await DRAFTS.flush()
+        await ADMIN_PENDING.flush()
+
+
+METRICS.gauge("drafts", lambda: len(DRAFTS))
+METRICS.gauge("media_groups", lambda: len(MEDIA_GROUPS))
+
+
+@dp.update.outer_middleware()
+async def drafts_middleware(handler, event, data):
+    """Подгружает черновик до хендлера и помечает его изменённым после."""
+    u = data.get("event_from_user")
+    if u:
+        await DRAFTS.load(u.id)
+        if is_admin_id(u.id):
+            await ADMIN_PENDING.load(u.id)
+    try:
+        return await handler(event, data)
+    finally:
+        if u:
+            DRAFTS.mark_dirty(u.id)
 
 
 FIELDS = [
@@ -205,171 +1615,1317 @@ FIELDS = [
 ]
 
 
-def targets() -> List[tuple[str, int]]:
-    res = [("🇧🇾", CHAT_BY_ID), ("🇩🇪", CHAT_DE_ID)]
-    if CHAT_RU_ID != 0:
-        res.append(("🇷🇺", CHAT_RU_ID))
-    return res
+# Реестр полей: ключ -> индекс в FIELDS и готовая подсказка
+FIELD_INDEX: Dict[str, int] = {k: i for i, (k, _, _) in enumerate(FIELDS)}
+
+
+def _build_prompt(key: str) -> str:
+    _, title, example = FIELDS[FIELD_INDEX[key]]
+    if key == "extra":
+        return (
+            f"{title}\n"
+            f"— Можно добавить любые нюансы.\n"
+            f"— Если не нужно: отправьте -"
+        )
+    return f"{title}\nПример: {example}"
+
+
+FIELD_PROMPTS: Dict[str, str] = {k: _build_prompt(k) for k, _, _ in FIELDS}
+
+# Код канала для выбора шаблона (post_<code>.txt)
+TARGET_CODES = {"🇧🇾": "BY", "🇩🇪": "DE", "🇷🇺": "RU"}
+
+
+def targets() -> List[tuple[str, int]]:
+    res = [("🇧🇾", CHAT_BY_ID), ("🇩🇪", CHAT_DE_ID)]
+    if CHAT_RU_ID != 0:
+        res.append(("🇷🇺", CHAT_RU_ID))
+    return res
+
+
+# ---------- Keyboards ----------
+# Клавиатуры статичны: собираем один раз и переиспользуем.
+@functools.lru_cache(maxsize=None)
+def kbd_new_mode() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🧾 У меня уже готовый текст", callback_data="new:ready")],
+        [InlineKeyboardButton(text="🧩 Заполнить по шагам", callback_data="new:wizard")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="new:cancel")],
+    ])
+
+
+@functools.lru_cache(maxsize=None)
+def _kbd_after_preview(mode: str) -> InlineKeyboardMarkup:
+    if mode.endswith(":edit"):
+        # правка опубликованного поста: меняется только текст, медиа и режим — как в каналах
+        edit = "act:edit_ready" if mode.startswith("ready") else "act:edit_menu"
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Обновить во всех каналах", callback_data="act:apply_edit")],
+            [InlineKeyboardButton(text="✏️ Изменить ещё", callback_data=edit)],
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="act:cancel")],
+        ])
+    rows = [
+        [InlineKeyboardButton(text="✅ Опубликовать во все каналы", callback_data="act:publish")],
+        [InlineKeyboardButton(text="🕒 Опубликовать позже", callback_data="act:schedule")],
+        [InlineKeyboardButton(text="➕ Добавить ещё фото", callback_data="act:add_more")],
+        [InlineKeyboardButton(text="🧹 Очистить медиа", callback_data="act:clear_media")],
+    ]
+    if mode == "ready":
+        rows.append([InlineKeyboardButton(text="✏️ Подправить текст", callback_data="act:edit_ready")])
+    else:
+        rows.append([InlineKeyboardButton(text="✏️ Изменить поле", callback_data="act:edit_menu")])
+
+    rows += [
+        [InlineKeyboardButton(text="🔁 Сменить режим", callback_data="act:switch_mode")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="act:cancel")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def preview_kbd_mode(d: Draft) -> str:
+    return ("ready" if d.mode == "ready" else "wizard") + (":edit" if d.editing_post else "")
+
+
+def kbd_after_preview(d: Draft) -> InlineKeyboardMarkup:
+    return _kbd_after_preview(preview_kbd_mode(d))
+
+
+@functools.lru_cache(maxsize=None)
+def kbd_edit_fields() -> InlineKeyboardMarkup:
+    rows, row = [], []
+    for k, title, _ in FIELDS:
+        text = "📝 Дополнительно" if k == "extra" else title
+        row.append(InlineKeyboardButton(text=text, callback_data=f"edit:{k}"))
+        if len(row) == 2:
+            rows.append(row)
+            row = []
+    if row:
+        rows.append(row)
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="act:back_preview")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+# ---------- Render & prompts ----------
+def prompt_for(key: str) -> str:
+    return FIELD_PROMPTS[key]
+
+
+DEFAULT_POST_TEMPLATE = (
+    "🚗 {brand_model}\n"
+    "💰 Стоимость: {price}\n"
+    "📅 Дата первичной регистрации: {reg_date}\n"
+    "📏 Пробег: {mileage}\n"
+    "🛠 Объём двигателя: {engine}\n"
+    "⛽️ Вид топлива: {fuel}\n"
+    "⚙️ Коробка передач: {gearbox}\n"
+    "🔋 Гибрид / Электро: {hybrid}\n"
+    "🛡 Технический осмотр: {inspection}\n"
+    "👥 Колличество владельцев: {owners}\n"
+    "🧩 Комплектация: {trim}\n"
+    "👤 Продавец: {seller}\n"
+    "📌 Прозвон. Получена подробная информация от продавца: {callcheck}"
+    "{extra_block}\n\n"
+    "💬 Заинтересовал автомобиль?\n"
+    "Напишите в ДИРЕКТ, чтобы получить детальный расчёт итоговой стоимости и полный обзор возможных нюансов и подводных камней при покупке этого автомобиля.\n\n"
+    "ℹ️  Пример автомобиля, доступного к приобретению.\n"
+    "Информация приведена на основе открытых данных объявления.\n\n"
+    "🔗 Ссылка может быть недоступна в отдельных регионах — это связано с локальными ограничениями доступа к сайту.\n\n"
+    "{link}"
+)
+
+
+class PostTemplate:
+    """Шаблон поста, разобранный один раз: [(литерал, поле | None), ...].
+
+    Плейсхолдеры — ключи FIELDS и {extra_block}; {{ и }} — литеральные скобки.
+    """
+
+    ALLOWED = set(FIELD_INDEX) | {"extra_block"}
+
+    def __init__(self, source: str, name: str = "default"):
+        self.name = name
+        self.parts: List[Tuple[str, Optional[str]]] = []
+        for literal, fname, spec, conv in string.Formatter().parse(source):
+            if fname is not None and (fname not in self.ALLOWED or spec or conv):
+                raise RuntimeError(f"Шаблон {name}: неизвестный плейсхолдер {{{fname}}}")
+            self.parts.append((literal, fname))
+
+    def render(self, d: Draft) -> str:
+        v = d.data
+        extra = (d.extra_text or "").strip()
+        extra_block = f"\n\n📝 Дополнительно:\n{extra}" if extra and extra != "-" else ""
+        out = []
+        for literal, fname in self.parts:
+            out.append(literal)
+            if fname == "extra_block":
+                out.append(extra_block)
+            elif fname:
+                out.append(v.get(fname, ""))
+        return "".join(out)
+
+
+# Код канала ("" — общий/предпросмотр) -> шаблон
+TEMPLATES: Dict[str, PostTemplate] = {"": PostTemplate(DEFAULT_POST_TEMPLATE)}
+
+
+def load_templates():
+    """Компилирует шаблоны из TEMPLATE_DIR один раз при старте (ошибка в шаблоне — ошибка старта)."""
+    base_path = os.path.join(TEMPLATE_DIR, "post.txt")
+    if os.path.exists(base_path):
+        with open(base_path, encoding="utf-8") as f:
+            TEMPLATES[""] = PostTemplate(f.read(), base_path)
+    for flag, _ in targets():
+        code = TARGET_CODES.get(flag, "")
+        path = os.path.join(TEMPLATE_DIR, f"post_{code}.txt")
+        if code and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                TEMPLATES[code] = PostTemplate(f.read(), path)
+    log_event("templates_loaded", templates=sorted(k or "default" for k in TEMPLATES))
+
+
+def render_wizard_post(d: Draft, code: str = "") -> str:
+    """Рендер по шаблону канала; результат кэшируется в черновике до следующего touch()."""
+    tpl = TEMPLATES.get(code) or TEMPLATES[""]
+    hit = d._rendered.get(tpl.name)
+    if hit and hit[0] == d.version:
+        return hit[1]
+    text = tpl.render(d)
+    d._rendered[tpl.name] = (d.version, text)
+    return text
+
+
+def render_final_text(d: Draft, code: str = "") -> str:
+    return d.ready_text.strip() if d.mode == "ready" else render_wizard_post(d, code)
+
+
+def target_code(flag: str) -> str:
+    return TARGET_CODES.get(flag, "")
+
+
+CAPTION_LIMIT = 1024
+
+
+def build_media_group(media: List[dict], caption: Optional[str]) -> list:
+    """InputMedia* для альбома; подпись только у первого элемента."""
+    media_group = []
+    for i, item in enumerate(media[:10]):
+        c = caption if i == 0 else None
+        if item["type"] == "photo":
+            media_group.append(InputMediaPhoto(media=item["file_id"], caption=c))
+        elif item["type"] == "video":
+            media_group.append(InputMediaVideo(media=item["file_id"], caption=c))
+        elif item["type"] == "document":
+            media_group.append(InputMediaDocument(media=item["file_id"], caption=c))
+    return media_group
+
+
+def split_caption(text: str) -> Tuple[str, str]:
+    """Текст -> (подпись альбома, хвост отдельным сообщением)."""
+    return text[:CAPTION_LIMIT], text[CAPTION_LIMIT:]
+
+
+PREVIEW_HEADER = "Предпросмотр:\n\n"
+PREVIEW_KBD_TEXT = "Выберите действие:"
+
+
+def preview_kbd_touched(d: Draft, message: Optional[Message]):
+    """Хендлер переписал сообщение с клавиатурой предпросмотра — при следующем обновлении вернуть его."""
+    if message is None or not d.preview or message.message_id != d.preview.get("kbd_id"):
+        return
+    d.preview["kbd_mode"] = None
+    if d.preview.get("text_id") == message.message_id:
+        d.preview["text"] = None
+
+
+async def _try_edit(call, raise_errors: bool = False) -> bool:
+    """Вызов edit_*; «message is not modified» считаем успехом.
+
+    raise_errors — прочие ошибки пробрасываются (правка постов в каналах), иначе -> False.
+    """
+    try:
+        await call
+        return True
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return True
+        if raise_errors:
+            raise
+        log_event("preview_edit_failed", error=str(e))
+        return False
+
+
+async def _edit_preview(bot: Bot, user_id: int, d: Draft, full: str, kb: InlineKeyboardMarkup) -> bool:
+    """Обновляет показанный предпросмотр на месте. False — правкой не выразить, нужен новый."""
+    p = d.preview
+    mode = preview_kbd_mode(d)
+    old_ids: List[int] = p.get("media_ids") or []
+
+    if not d.media:
+        if old_ids or not p.get("text_id"):
+            return False
+        if full == p.get("text") and p.get("kbd_mode") == mode:
+            return True
+        ok = await _try_edit(bot.edit_message_text(
+            text=full, chat_id=user_id, message_id=p["text_id"], reply_markup=kb,
+        ))
+        if ok:
+            p.update(text=full, kbd_mode=mode)
+        return ok
+
+    # альбом не растёт и не появляется из ничего; хвост текста не вставить перед клавиатурой
+    cap, rest = split_caption(full)
+    has_rest = bool(rest.strip())
+    if not old_ids or len(d.media) > len(old_ids) or (has_rest and not p.get("text_id")):
+        return False
+
+    old_media: List[dict] = p.get("media") or []
+    if len(d.media) < len(old_ids):
+        extra = old_ids[len(d.media):]
+        try:
+            await bot.delete_messages(chat_id=user_id, message_ids=extra)
+        except TelegramBadRequest:
+            return False
+        old_ids = old_ids[:len(d.media)]
+        p.update(media_ids=old_ids, media=old_media[:len(d.media)])
+
+    caption_done = False
+    for i, item in enumerate(d.media):
+        if i < len(old_media) and item == old_media[i]:
+            continue
+        new_item = build_media_group([item], cap if i == 0 else None)[0]
+        if not await _try_edit(bot.edit_message_media(chat_id=user_id, message_id=old_ids[i], media=new_item)):
+            return False
+        caption_done = caption_done or i == 0
+    p["media"] = [dict(x) for x in d.media]
+
+    if not caption_done and cap != p.get("caption"):
+        if not await _try_edit(bot.edit_message_caption(chat_id=user_id, message_id=old_ids[0], caption=cap)):
+            return False
+    p["caption"] = cap
+
+    if has_rest and rest != p.get("text"):
+        if not await _try_edit(bot.edit_message_text(text=rest, chat_id=user_id, message_id=p["text_id"])):
+            return False
+    elif not has_rest and p.get("text_id"):
+        try:
+            await bot.delete_message(chat_id=user_id, message_id=p["text_id"])
+        except TelegramBadRequest:
+            pass
+        p["text_id"] = None
+    p["text"] = rest if has_rest else None
+
+    if p.get("kbd_mode") != mode:
+        if not await _try_edit(bot.edit_message_text(
+            text=PREVIEW_KBD_TEXT, chat_id=user_id, message_id=p["kbd_id"], reply_markup=kb,
+        )):
+            return False
+        p["kbd_mode"] = mode
+    return True
+
+
+async def _drop_preview(bot: Bot, user_id: int, d: Draft):
+    """Удаляет старый предпросмотр перед отправкой нового (best effort)."""
+    p = d.preview
+    ids = list(p.get("media_ids") or [])
+    for key in ("text_id", "kbd_id"):
+        if p.get(key) and p[key] not in ids:
+            ids.append(p[key])
+    d.preview = {}
+    if not ids:
+        return
+    try:
+        await bot.delete_messages(chat_id=user_id, message_ids=ids)
+    except TelegramBadRequest as e:
+        log_event("preview_drop_failed", chat_id=user_id, error=str(e))
+
+
+@timed("send_preview")
+async def send_preview(bot: Bot, user_id: int, d: Draft) -> None:
+    text = render_final_text(d)
+    kb = kbd_after_preview(d)
+    full = PREVIEW_HEADER + text
+    mode = preview_kbd_mode(d)
+
+    log_event(
+        "send_preview",
+        user=None,
+        chat_id=user_id,
+        message_id=None,
+        mode=d.mode,
+        finalized=d.finalized,
+        media_count=len(d.media),
+        text_len=len(text),
+        in_place=bool(d.preview),
+    )
+
+    try:
+        if d.preview:
+            if await _edit_preview(bot, user_id, d, full, kb):
+                METRICS.inc("preview_total", "kind", "edit")
+                return
+            await _drop_preview(bot, user_id, d)
+        METRICS.inc("preview_total", "kind", "send")
+
+        if not d.media:
+            msg = await bot.send_message(user_id, full, reply_markup=kb)
+            d.preview = {"media": [], "media_ids": [], "caption": None,
+                         "text_id": msg.message_id, "text": full,
+                         "kbd_id": msg.message_id, "kbd_mode": mode}
+            return
+
+        cap, rest = split_caption(full)
+        msgs = await bot.send_media_group(chat_id=user_id, media=build_media_group(d.media, cap))
+        rest_id = None
+        if rest.strip():
+            rest_id = (await bot.send_message(user_id, rest)).message_id
+        kbd = await bot.send_message(user_id, PREVIEW_KBD_TEXT, reply_markup=kb)
+        d.preview = {"media": [dict(x) for x in d.media[:10]], "media_ids": [x.message_id for x in msgs],
+                     "caption": cap, "text_id": rest_id, "text": rest if rest_id else None,
+                     "kbd_id": kbd.message_id, "kbd_mode": mode}
+    finally:
+        DRAFTS.mark_dirty(user_id)
+
+
+class PreviewScheduler:
+    """Схлопывает серии запросов предпросмотра в один.
+
+    request() откладывает предпросмотр на PREVIEW_DEBOUNCE_MS; каждый новый
+    запрос того же пользователя перезапускает окно. now() — сразу (ответ на
+    текст), но тоже отменяет отложенный. Отправки одного пользователя идут
+    строго по очереди под user_lock: now() зовут хендлеры, уже держащие его,
+    _run берёт его сам. Если за время ожидания пришёл более свежий запрос или
+    черновика уже нет, устаревший предпросмотр не отправляется.
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending) + len(self._tasks)
+
+    def cancel(self, uid: int) -> bool:
+        h = self._pending.pop(uid, None)
+        if h:
+            h.cancel()
+        return h is not None
+
+    def request(self, bot: Bot, uid: int):
+        if self.cancel(uid):
+            METRICS.inc("preview_coalesced_total")
+        loop = asyncio.get_running_loop()
+        self._pending[uid] = loop.call_later(PREVIEW_DEBOUNCE_MS / 1000, self._fire, bot, uid)
+
+    async def now(self, bot: Bot, uid: int, d: Draft):
+        if self.cancel(uid):
+            METRICS.inc("preview_coalesced_total")
+        await send_preview(bot, uid, d)
+
+    def flush_all(self, bot: Bot):
+        """Остановка: отложенные предпросмотры отправляются сразу."""
+        for uid, h in list(self._pending.items()):
+            h.cancel()
+            self._fire(bot, uid)
+
+    def _fire(self, bot: Bot, uid: int):
+        self._pending.pop(uid, None)
+        task = asyncio.create_task(self._run(bot, uid))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, bot: Bot, uid: int):
+        # отложенный предпросмотр ждёт хендлеры пользователя, чтобы показать их итог
+        async with user_lock(uid):
+            d = DRAFTS.get(uid)
+            if uid in self._pending or not d or not d.finalized:
+                METRICS.inc("preview_stale_total")
+                return
+            try:
+                await send_preview(bot, uid, d)
+            except Exception as e:
+                logger.warning("preview failed uid=%s: %r", uid, e)
+
+
+PREVIEWS = PreviewScheduler()
+
+
+# ---------- Publishing ----------
+@dataclass
+class PublishResult:
+    flag: str
+    chat_id: int
+    ok: bool
+    message_ids: List[int] = field(default_factory=list)
+    error: str = ""
+    retry_after: float = 0.0
+
+
+_CHAT_SEMAPHORES: Dict[int, asyncio.Semaphore] = {}
+
+SCHEDULE_PROMPT = (
+    "🕒 Когда опубликовать? Пришлите время одним сообщением:\n"
+    "• 18:30 — сегодня (или завтра, если уже прошло)\n"
+    "• 25.12 09:00 или 25.12.2025 09:00\n"
+    "• +30м, +2ч, +1д — через сколько\n\n"
+    "Чтобы передумать — нажмите кнопку под предпросмотром."
+)
+_RELATIVE_RE = re.compile(r"^\+\s*(\d+)\s*(м|мин|m|ч|h|д|d)$", re.IGNORECASE)
+_RELATIVE_UNITS = {"м": 60, "мин": 60, "m": 60, "ч": 3600, "h": 3600, "д": 86400, "d": 86400}
+_ABSOLUTE_FORMATS = ("%H:%M", "%d.%m %H:%M", "%d.%m.%Y %H:%M")
+
+
+def parse_publish_time(text: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """Время публикации из ввода автора (PUBLISH_ZONE). None — не разобрали или вне горизонта."""
+    now = now or datetime.now(PUBLISH_ZONE)
+    text = " ".join(text.split())
+    m = _RELATIVE_RE.match(text)
+    if m:
+        # «через N» — реальные секунды: считаем в UTC, чтобы переход на летнее время не сдвигал час
+        delta = timedelta(seconds=int(m.group(1)) * _RELATIVE_UNITS[m.group(2).lower()])
+        at = (now.astimezone(timezone.utc) + delta).astimezone(PUBLISH_ZONE)
+    else:
+        at = None
+        for fmt in _ABSOLUTE_FORMATS:
+            if fmt == "%H:%M":
+                try:
+                    parsed = datetime.strptime(text, fmt)
+                except ValueError:
+                    continue
+                at = now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+                if at <= now:
+                    at += timedelta(days=1)
+            elif "%Y" in fmt:
+                try:
+                    at = datetime.strptime(text, fmt).replace(tzinfo=PUBLISH_ZONE)
+                except ValueError:
+                    continue
+            else:
+                # год подставляем до разбора: без него strptime берёт 1900 и отвергает 29.02
+                for year in (now.year, now.year + 1):
+                    try:
+                        at = datetime.strptime(f"{text} {year}", fmt + " %Y").replace(tzinfo=PUBLISH_ZONE)
+                    except ValueError:
+                        continue
+                    if at > now:
+                        break
+                if at is None:
+                    continue
+            break
+        if at is None:
+            return None
+    if at <= now or at - now > timedelta(days=SCHEDULE_MAX_DAYS):
+        return None
+    return at
+
+
+def chat_semaphore(chat_id: int) -> asyncio.Semaphore:
+    sem = _CHAT_SEMAPHORES.get(chat_id)
+    if sem is None:
+        sem = _CHAT_SEMAPHORES[chat_id] = asyncio.Semaphore(max(1, PUBLISH_PER_CHAT_CONCURRENCY))
+    return sem
+
+
+async def publish_one(bot: Bot, flag: str, chat_id: int, text: str, media_group: list, rest: str) -> PublishResult:
+    """Отправка поста в один канал. Альбом и хвост текста — строго по порядку."""
+    async with chat_semaphore(chat_id):
+        try:
+            ids = []
+            if media_group:
+                msgs = await bot.send_media_group(chat_id=chat_id, media=media_group)
+                ids += [x.message_id for x in msgs]
+                if rest.strip():
+                    ids.append((await bot.send_message(chat_id, rest)).message_id)
+            else:
+                ids.append((await bot.send_message(chat_id, text)).message_id)
+            return PublishResult(flag, chat_id, True, ids)
+        except Exception as e:
+            log_event("publish_failed", chat_id=chat_id, flag=flag, error=repr(e))
+            retry_after = e.retry_after if isinstance(e, TelegramRetryAfter) else 0.0
+            return PublishResult(flag, chat_id, False, error=str(e), retry_after=retry_after)
+
+
+async def copy_one(bot: Bot, flag: str, chat_id: int, from_chat_id: int, message_ids: List[int]) -> PublishResult:
+    """Копия уже опубликованного поста (альбом + хвост) одним copyMessages."""
+    async with chat_semaphore(chat_id):
+        try:
+            ids = await bot.copy_messages(chat_id=chat_id, from_chat_id=from_chat_id, message_ids=message_ids)
+            return PublishResult(flag, chat_id, True, [x.message_id for x in ids])
+        except Exception as e:
+            log_event("copy_failed", chat_id=chat_id, flag=flag, from_chat_id=from_chat_id, error=repr(e))
+            return PublishResult(flag, chat_id, False, error=str(e))
+
+
+# ---------- Outbox ----------
+SQL_OUTBOX_CREATE = (
+    "CREATE TABLE IF NOT EXISTS outbox ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "post_id TEXT NOT NULL, "
+    "author_id INTEGER NOT NULL, "
+    "flag TEXT NOT NULL, "
+    "chat_id INTEGER NOT NULL, "
+    "text TEXT NOT NULL, "
+    "media TEXT NOT NULL, "
+    "status TEXT NOT NULL DEFAULT 'pending', "  # pending | sending | sent | failed
+    "attempts INTEGER NOT NULL DEFAULT 0, "
+    "next_at REAL NOT NULL, "
+    "message_ids TEXT, "
+    "error TEXT, "
+    "created_at REAL NOT NULL, "
+    "shard INTEGER NOT NULL DEFAULT 0, "  # воркер-владелец (SHARD_INDEX)
+    "source_id INTEGER, "  # PUBLISH_FANOUT=copy: строка, с которой копируем
+    "lease_until REAL)"  # sending: строку взял воркер, до этого времени её не трогают другие
+)
+# Колонки, добавленные позже: докатываются на старые bot.db миграциями SCHEMA_MIGRATIONS
+SQL_OUTBOX_MIGRATIONS = {
+    "shard": "ALTER TABLE outbox ADD COLUMN shard INTEGER NOT NULL DEFAULT 0",
+    "source_id": "ALTER TABLE outbox ADD COLUMN source_id INTEGER",
+}
+SQL_OUTBOX_LEASE_MIGRATIONS = {
+    "lease_until": "ALTER TABLE outbox ADD COLUMN lease_until REAL",
+}
+SQL_OUTBOX_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS outbox_pending ON outbox(status, next_at)",
+    "CREATE INDEX IF NOT EXISTS outbox_post ON outbox(post_id)",
+)
+SQL_OUTBOX_INSERT = (
+    "INSERT INTO outbox(post_id, author_id, flag, chat_id, text, media, next_at, created_at, shard, source_id) "
+    "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_OUTBOX_PENDING = "SELECT id, next_at FROM outbox WHERE status='pending' AND shard % ? = ?"
+SQL_OUTBOX_EXPIRED = "UPDATE outbox SET status='pending', lease_until=NULL WHERE status='sending' AND lease_until < ?"
+# Захват строки перед отправкой: отправляет только тот экземпляр, чей UPDATE изменил строку
+SQL_OUTBOX_CLAIM = (
+    "UPDATE outbox SET status='sending', lease_until=? "
+    "WHERE id=? AND ((status='pending' AND next_at <= ?) OR (status='sending' AND lease_until < ?))"
+)
+SQL_OUTBOX_RELEASE = "UPDATE outbox SET status='pending', lease_until=NULL WHERE id=? AND status='sending'"
+SQL_OUTBOX_GET = (
+    "SELECT id, post_id, author_id, flag, chat_id, text, media, status, attempts, source_id "
+    "FROM outbox WHERE id=?"
+)
+SQL_OUTBOX_SOURCE = "SELECT chat_id, status, message_ids FROM outbox WHERE id=?"
+SQL_OUTBOX_NEXT_AT = "SELECT next_at FROM outbox WHERE id=? AND status='pending'"
+SQL_OUTBOX_COPIES = "SELECT id FROM outbox WHERE source_id=? AND status='pending'"
+SQL_OUTBOX_SLOT_TAKEN = (
+    "SELECT 1 FROM outbox WHERE status IN ('pending', 'sending') AND next_at > ? AND next_at < ? LIMIT 1"
+)
+SQL_OUTBOX_RETRY = (
+    "UPDATE outbox SET status='pending', lease_until=NULL, attempts=?, next_at=?, error=? WHERE id=?"
+)
+SQL_OUTBOX_FINISH = "UPDATE outbox SET status=?, lease_until=NULL, attempts=?, message_ids=?, error=? WHERE id=?"
+SQL_OUTBOX_POST_PENDING = "SELECT COUNT(*) FROM outbox WHERE post_id=? AND status IN ('pending', 'sending')"
+SQL_OUTBOX_POST_REPORT = "SELECT flag, status, error FROM outbox WHERE post_id=? ORDER BY id"
+# Правка/снятие поста, часть каналов которого ещё в очереди
+SQL_OUTBOX_POST_SENDING = "SELECT COUNT(*) FROM outbox WHERE post_id=? AND status='sending'"
+SQL_OUTBOX_POST_QUEUED = "SELECT id, flag FROM outbox WHERE post_id=? AND status='pending' ORDER BY id"
+SQL_OUTBOX_POST_DROP = "DELETE FROM outbox WHERE post_id=? AND status='pending'"
+SQL_OUTBOX_SET_TEXT = "UPDATE outbox SET text=? WHERE id=? AND status='pending'"
+
+
+@dataclass
+class OutboxJob:
+    id: int
+    post_id: str
+    author_id: int
+    flag: str
+    chat_id: int
+    text: str
+    media: str
+    status: str
+    attempts: int
+    source_id: Optional[int]
+
+
+class Outbox:
+    """Очередь публикаций в bot.db + пул воркеров.
+
+    Строка outbox = пост в одном канале (готовый текст + список медиа).
+    Сроки (новые задачи и ретраи с backoff) держим в min-heap по next_at:
+    диспетчер спит ровно до ближайшего срока и раздаёт созревшие задачи
+    воркерам через ограниченную очередь. После рестарта незавершённые строки
+    поднимаются из БД и догоняются.
+
+    PUBLISH_FANOUT=copy: строки с тем же текстом, что у первого канала, ссылаются
+    на него (source_id) и ставятся в очередь, когда он завершится — тогда пост
+    копируется copyMessages по его message_ids вместо повторной загрузки.
+    """
+
+    def __init__(self):
+        self.bot: Optional[Bot] = None
+        self._heap: List[Tuple[float, int]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Set[int] = set()
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=max(1, OUTBOX_WORKERS))
+        expired = await STORAGE.execute(SQL_OUTBOX_EXPIRED, (time.time(),))
+        if expired:
+            log_event("outbox_leases_expired", rows=expired)
+        for job_id, next_at in await STORAGE.fetchall(SQL_OUTBOX_PENDING, (SHARD_COUNT, SHARD_INDEX)):
+            self._schedule(job_id, next_at)
+        self._tasks = [asyncio.create_task(self._dispatcher())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(max(1, OUTBOX_WORKERS))]
+        METRICS.gauge("outbox_scheduled", lambda: len(self._heap))
+        log_event("outbox_started", pending=len(self._heap), workers=OUTBOX_WORKERS)
+
+    async def stop(self, timeout: float = 0):
+        """Останавливает пул. С timeout — сначала даёт доделать начатое и созревшее.
+
+        Ретраи и отложенные посты остаются pending в bot.db и поднимутся при старте.
+        Строки, прерванные по дедлайну, тоже остаются pending и будут отправлены заново.
+        """
+        deadline = time.monotonic() + timeout
+        while self._tasks and time.monotonic() < deadline and (
+            self._running or (self._queue and self._queue.qsize()) or (self._heap and self._heap[0][0] <= time.time())
+        ):
+            await asyncio.sleep(0.05)
+        interrupted = sorted(self._running)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if interrupted:
+            # прерванные строки возвращаем в pending сразу, не дожидаясь конца аренды
+            await STORAGE.executemany(SQL_OUTBOX_RELEASE, [(job_id,) for job_id in interrupted])
+            log_event("outbox_interrupted", jobs=interrupted)
+
+    def _schedule(self, job_id: int, at: float):
+        heapq.heappush(self._heap, (at, job_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def enqueue(self, author_id: int, posts: List[Tuple[str, int, str]], media: List[dict],
+                      at: Optional[float] = None,
+                      archive: Optional[Callable[[sqlite3.Connection, str], None]] = None) -> str:
+        """Записывает пост во все каналы [(флаг, chat_id, текст)] одной транзакцией. Возвращает post_id.
+
+        archive(con, post_id) выполняется в той же транзакции (запись в архив постов).
+        """
+        post_id = uuid.uuid4().hex
+        now = time.time()
+        at = at or now
+        media_json = json.dumps(media, ensure_ascii=False)
+        rows = [
+            (post_id, author_id, flag, chat_id, text, media_json, at, now, SHARD_INDEX)
+            for flag, chat_id, text in posts
+        ]
+        primary_text = posts[0][2] if posts else None
+
+        def write(con: sqlite3.Connection) -> List[int]:
+            # copy: каналы с тем же текстом ждут первый и копируют его; свой шаблон — своя отправка
+            if archive is not None:
+                archive(con, post_id)
+            ids, source_id = [], None
+            for r in rows:
+                copy = PUBLISH_FANOUT == "copy" and source_id is not None and r[4] == primary_text
+                job_id = con.execute(SQL_OUTBOX_INSERT, (*r, source_id if copy else None)).lastrowid
+                if source_id is None:
+                    source_id = job_id
+                if not copy:
+                    ids.append(job_id)
+            return ids
+
+        for job_id in await STORAGE.transaction(write):
+            self._schedule(job_id, at)
+        log_event("outbox_enqueued", chat_id=author_id, post_id=post_id, targets=len(rows), at=at,
+                  fanout=PUBLISH_FANOUT)
+        return post_id
+
+    async def free_slot(self, at: float) -> float:
+        """Ближайшее время >= at, в окрестности SCHEDULE_SLOT_SEC которого нет других публикаций.
+
+        Посты, запланированные «на 9:00», выходят по одному с интервалом, а не пачкой.
+        """
+        slot = SCHEDULE_SLOT_SEC
+        for _ in range(100):
+            if not slot or not await STORAGE.fetchall(SQL_OUTBOX_SLOT_TAKEN, (at - slot, at + slot)):
+                break
+            at += slot
+        return at
+
+    async def _dispatcher(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            at, job_id = self._heap[0]
+            delay = at - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            await self._queue.put(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            if job_id in self._running:
+                # та же строка уже в работе (двойное планирование после рестарта)
+                self._schedule(job_id, time.time() + 1)
+                self._queue.task_done()
+                continue
+            self._running.add(job_id)
+            try:
+                await self._process(job_id)
+            except Exception as e:
+                logger.exception("outbox job %s crashed: %r", job_id, e)
+                await STORAGE.execute(SQL_OUTBOX_RELEASE, (job_id,))
+                self._schedule(job_id, time.time() + OUTBOX_BACKOFF)
+            finally:
+                self._running.discard(job_id)
+                self._queue.task_done()
+
+    async def _claim(self, job_id: int) -> bool:
+        """Атомарно берёт строку в работу (status=sending + аренда).
+
+        Строку держат в куче все экземпляры, поднявшие её из bot.db (рестарт
+        внахлёст, несколько webhook-инстансов) — отправляет только захвативший.
+        Не удалось: строка уже у другого или её срок перенесён (ретрай) — тогда
+        планируем её на новый срок.
+        """
+        now = time.time()
+        if await STORAGE.execute(SQL_OUTBOX_CLAIM, (now + OUTBOX_LEASE_SEC, job_id, now, now)):
+            return True
+        rows = await STORAGE.fetchall(SQL_OUTBOX_NEXT_AT, (job_id,))
+        if rows and rows[0][0] > now:
+            self._schedule(job_id, rows[0][0])
+        return False
+
+    @timed("outbox_job")
+    async def _process(self, job_id: int):
+        if not await self._claim(job_id):
+            return
+        rows = await STORAGE.fetchall(SQL_OUTBOX_GET, (job_id,))
+        if not rows:
+            return
+        job = OutboxJob(*rows[0])
+
+        res = None
+        if job.source_id is not None:
+            src_chat_id, src_status, src_ids = (await STORAGE.fetchall(SQL_OUTBOX_SOURCE, (job.source_id,)))[0]
+            if src_status in ("pending", "sending"):
+                # запланируется, когда завершится исходная строка
+                await STORAGE.execute(SQL_OUTBOX_RELEASE, (job.id,))
+                return
+            if src_status == "sent":
+                res = await copy_one(self.bot, job.flag, job.chat_id, src_chat_id, json.loads(src_ids))
+                METRICS.inc("publish_copies_total", "result", "ok" if res.ok else "fallback")
+                if not res.ok:
+                    res = None
+        if res is None:
+            cap, rest = split_caption(job.text)
+            media = json.loads(job.media)
+            media_group = build_media_group(media, cap) if media else []
+            res = await publish_one(self.bot, job.flag, job.chat_id, job.text, media_group, rest)
+        attempts = job.attempts + 1
+
+        if not res.ok and attempts < OUTBOX_MAX_ATTEMPTS:
+            delay = max(res.retry_after, min(OUTBOX_BACKOFF * 2 ** (attempts - 1), 300))
+            await STORAGE.execute(SQL_OUTBOX_RETRY, (attempts, time.time() + delay, res.error, job.id))
+            self._schedule(job.id, time.time() + delay)
+            log_event("outbox_retry", chat_id=job.chat_id, post_id=job.post_id, attempts=attempts, delay=delay)
+            return
+
+        status = "sent" if res.ok else "failed"
+        ids = json.dumps(res.message_ids)
+
+        def finish(con: sqlite3.Connection) -> Tuple[bool, List[int]]:
+            con.execute(SQL_OUTBOX_FINISH, (status, attempts, ids, res.error or None, job.id))
+            if res.ok:
+                ARCHIVE.add_messages(con, job.post_id, job.chat_id, job.flag, ids)
+            copies = [r[0] for r in con.execute(SQL_OUTBOX_COPIES, (job.id,))]
+            return con.execute(SQL_OUTBOX_POST_PENDING, (job.post_id,)).fetchone()[0] == 0, copies
+
+        done, copies = await STORAGE.transaction(finish)
+        for copy_id in copies:
+            self._schedule(copy_id, time.time())
+        if done:
+            await self._report(job.post_id, job.author_id)
+
+    async def _report(self, post_id: str, author_id: int):
+        rows = await STORAGE.fetchall(SQL_OUTBOX_POST_REPORT, (post_id,))
+        ok = [flag for flag, status, _ in rows if status == "sent"]
+        failed = [flag for flag, status, _ in rows if status != "sent"]
+        log_event("publish_done", chat_id=author_id, post_id=post_id, ok=ok, failed=failed)
+        if not ok:
+            # пост никуда не вышел — освобождаем ссылку для повторной публикации
+            await STORAGE.transaction(lambda con: ARCHIVE.forget(con, post_id))
+
+        report = "Добавлен пост в каналы: " + (" ".join(ok) or "—")
+        if failed:
+            report += "\n⚠️ Не удалось опубликовать: " + " ".join(failed)
+        kb = InlineKeyboardMarkup(inline_keyboard=[kbd_post_actions(post_id)]) if ok else None
+        try:
+            await self.bot.send_message(author_id, report, reply_markup=kb)
+        except Exception as e:
+            logger.warning("outbox report failed post=%s: %r", post_id, e)
+
+
+OUTBOX = Outbox()
+
+
+async def enqueue_draft(uid: int, d: Draft, at: Optional[float] = None) -> str:
+    """Ставит готовый черновик в outbox: текст по шаблону каждого канала + общие медиа.
+
+    В той же транзакции пост пишется в архив; повтор ссылки -> DuplicatePost.
+    """
+    posts = [(flag, chat_id, render_final_text(d, target_code(flag))) for flag, chat_id in targets()]
+    link_hash = draft_link_hash(d)
+    dup = await ARCHIVE.find_by_link(link_hash)
+    if dup:
+        raise DuplicatePost(*dup)
+    try:
+        return await OUTBOX.enqueue(
+            uid, posts, d.media, at=at,
+            archive=lambda con, post_id: ARCHIVE.record(con, post_id, uid, d, link_hash),
+        )
+    except sqlite3.IntegrityError:
+        raise DuplicatePost(*(await ARCHIVE.find_by_link(link_hash) or ("", 0.0)))
+
+
+# ---------- Archive of published posts ----------
+SQL_ARCHIVE_CREATE = (
+    "CREATE TABLE IF NOT EXISTS published_posts ("
+    "id INTEGER PRIMARY KEY, "  # стабильный ключ строки в published_fts
+    "post_id TEXT NOT NULL UNIQUE, "
+    "author_id INTEGER NOT NULL, "
+    "created_at REAL NOT NULL, "
+    "text TEXT NOT NULL, "  # текст по общему шаблону
+    "draft TEXT NOT NULL, "  # черновик целиком (draft_to_json)
+    "link_hash TEXT, "  # sha1 нормализованной ссылки на объявление
+    "retracted_at REAL)"  # пост снят из каналов
+)
+SQL_ARCHIVE_MIGRATIONS = {
+    "retracted_at": "ALTER TABLE published_posts ADD COLUMN retracted_at REAL",
+}
+SQL_ARCHIVE_MESSAGES_CREATE = (
+    "CREATE TABLE IF NOT EXISTS published_messages ("
+    "post_id TEXT NOT NULL, "
+    "chat_id INTEGER NOT NULL, "
+    "flag TEXT NOT NULL, "
+    "message_ids TEXT NOT NULL, "
+    "PRIMARY KEY(post_id, chat_id))"
+)
+SQL_ARCHIVE_INDEXES = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS published_link ON published_posts(link_hash) WHERE link_hash IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS published_created ON published_posts(created_at)",
+)
+SQL_ARCHIVE_FTS_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS published_fts "
+    "USING fts5(text, data, tokenize='unicode61 remove_diacritics 2')"
+)
+SQL_ARCHIVE_INSERT = (
+    "INSERT INTO published_posts(post_id, author_id, created_at, text, draft, link_hash) "
+    "VALUES(?, ?, ?, ?, ?, ?)"
+)
+SQL_ARCHIVE_FTS_INSERT = "INSERT INTO published_fts(rowid, text, data) VALUES(?, ?, ?)"
+SQL_ARCHIVE_FTS_DELETE = "DELETE FROM published_fts WHERE rowid=(SELECT id FROM published_posts WHERE post_id=?)"
+SQL_ARCHIVE_MESSAGES_SET = "UPDATE published_messages SET message_ids=? WHERE post_id=? AND chat_id=?"
+SQL_ARCHIVE_DELETE = "DELETE FROM published_posts WHERE post_id=?"
+SQL_ARCHIVE_ROWID = "SELECT id FROM published_posts WHERE post_id=?"
+SQL_ARCHIVE_MESSAGES_DELETE = "DELETE FROM published_messages WHERE post_id=?"
+SQL_ARCHIVE_MESSAGES_UPSERT = (
+    "INSERT OR REPLACE INTO published_messages(post_id, chat_id, flag, message_ids) VALUES(?, ?, ?, ?)"
+)
+SQL_ARCHIVE_MESSAGES = "SELECT flag, chat_id, message_ids FROM published_messages WHERE post_id=? ORDER BY rowid"
+SQL_ARCHIVE_BY_LINK = "SELECT post_id, created_at FROM published_posts WHERE link_hash=?"
+SQL_ARCHIVE_GET = "SELECT post_id, created_at, text, retracted_at FROM published_posts WHERE post_id=?"
+SQL_ARCHIVE_POST = "SELECT author_id, draft, retracted_at FROM published_posts WHERE post_id=?"
+SQL_ARCHIVE_UPDATE = "UPDATE published_posts SET text=?, draft=?, link_hash=? WHERE post_id=?"
+SQL_ARCHIVE_RETRACT = "UPDATE published_posts SET retracted_at=?, link_hash=NULL WHERE post_id=?"
+SQL_ARCHIVE_SEARCH_FTS = (
+    "SELECT p.post_id, p.created_at, p.text, p.retracted_at FROM published_fts f "
+    "JOIN published_posts p ON p.id = f.rowid "
+    "WHERE published_fts MATCH ? ORDER BY f.rank LIMIT ?"
+)
+SQL_ARCHIVE_SEARCH_LIKE = (
+    "SELECT post_id, created_at, text, retracted_at FROM published_posts "
+    "WHERE text LIKE ? ESCAPE '\\' OR draft LIKE ? ESCAPE '\\' ORDER BY created_at DESC LIMIT ?"
+)
+
+_URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
+_HOST_PREFIXES = ("www.", "m.", "suchen.")
+# Площадки объявлений: в готовом тексте ключом дубля служат только их ссылки
+# (контакты, каналы и соцсети продавца повторяются от поста к посту)
+LISTING_HOSTS = ("mobile.de", "autoscout24.de", "autoscout24.com", "autoscout24.at", "kleinanzeigen.de")
+
+
+def normalize_link(url: str) -> Optional[str]:
+    """Ссылка на объявление -> стабильный ключ: без схемы, www./m., utm-меток и хвостового /.
+
+    Для mobile.de ключ — id объявления (из ?id= или из пути), остальное в URL меняется.
+    У прочих сайтов query остаётся в ключе: объявление может задаваться именно им.
+    """
+    try:
+        u = urllib.parse.urlsplit(url.strip())
+    except ValueError:
+        return None
+    host = (u.hostname or "").lower()
+    if not host:
+        return None
+    for prefix in _HOST_PREFIXES:
+        host = host.removeprefix(prefix)
+    if host == "mobile.de":
+        ad_id = urllib.parse.parse_qs(u.query).get("id", [None])[0]
+        if not ad_id:
+            m = re.search(r"(\d{6,})", u.path)
+            ad_id = m.group(1) if m else None
+        if ad_id:
+            return f"mobile.de/id/{ad_id}"
+    query = sorted((k, v) for k, v in urllib.parse.parse_qsl(u.query) if not k.lower().startswith("utm_"))
+    key = host + u.path.rstrip("/")
+    return key + "?" + urllib.parse.urlencode(query) if query else key
+
+
+def draft_link_hash(d: Draft) -> Optional[str]:
+    """sha1 ключа ссылки на объявление: поле «ссылка» мастера или ссылка площадки в готовом тексте.
+
+    Пост, опубликованный админом поверх дубля, ключа не получает.
+    """
+    if d.allow_duplicate:
+        return None
+    if d.mode == "wizard":
+        m = _URL_RE.search(d.data.get("link", ""))
+        key = normalize_link(m.group(0)) if m else None
+    else:
+        keys = (normalize_link(url) for url in _URL_RE.findall(d.ready_text))
+        key = next((k for k in keys if k and k.split("/", 1)[0] in LISTING_HOSTS), None)
+    return hashlib.sha1(key.encode()).hexdigest() if key else None
+
+
+class DuplicatePost(Exception):
+    def __init__(self, post_id: str, created_at: float):
+        super().__init__(post_id)
+        self.post_id = post_id
+        self.created_at = created_at
+
+
+class PostBusy(Exception):
+    """Строку outbox поста прямо сейчас отправляет воркер: правку/снятие нужно повторить позже."""
+
+
+class PostArchive:
+    """published_posts + message_ids по каналам + FTS5 по тексту и полям мастера.
+
+    Если SQLite собран без FTS5, поиск деградирует до LIKE по тексту.
+    Синхронные методы (record, add_messages, forget) вызываются внутри транзакций outbox.
+    """
+
+    def __init__(self):
+        self.fts = False
+
+    async def init(self):
+        await STORAGE.execute(SQL_ARCHIVE_CREATE)
+        await STORAGE.execute(SQL_ARCHIVE_MESSAGES_CREATE)
+        for sql in SQL_ARCHIVE_INDEXES:
+            await STORAGE.execute(sql)
+        try:
+            await STORAGE.execute(SQL_ARCHIVE_FTS_CREATE)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning("FTS5 недоступен, /find работает через LIKE: %r", e)
 
+    def record(self, con: sqlite3.Connection, post_id: str, author_id: int, d: Draft, link_hash: Optional[str]):
+        text = render_final_text(d)
+        cur = con.execute(SQL_ARCHIVE_INSERT, (post_id, author_id, time.time(), text, draft_to_json(d), link_hash))
+        if self.fts:
+            con.execute(SQL_ARCHIVE_FTS_INSERT, (cur.lastrowid, text, self._fts_data(d)))
 
-# ---------- Keyboards ----------
-def kbd_new_mode() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🧾 У меня уже готовый текст", callback_data="new:ready")],
-        [InlineKeyboardButton(text="🧩 Заполнить по шагам", callback_data="new:wizard")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="new:cancel")],
+    @staticmethod
+    def _fts_data(d: Draft) -> str:
+        return " ".join([*d.data.values(), d.extra_text])
+
+    def update(self, con: sqlite3.Connection, post_id: str, d: Draft, link_hash: Optional[str]):
+        text = render_final_text(d)
+        con.execute(SQL_ARCHIVE_UPDATE, (text, draft_to_json(d), link_hash, post_id))
+        if self.fts:
+            rowid = con.execute(SQL_ARCHIVE_ROWID, (post_id,)).fetchone()[0]
+            con.execute(SQL_ARCHIVE_FTS_DELETE, (post_id,))
+            con.execute(SQL_ARCHIVE_FTS_INSERT, (rowid, text, self._fts_data(d)))
+
+    def retract(self, con: sqlite3.Connection, post_id: str):
+        con.execute(SQL_ARCHIVE_RETRACT, (time.time(), post_id))
+
+    async def get(self, post_id: str) -> Optional[Tuple[int, Draft, Optional[float]]]:
+        """(автор, черновик, когда снят) опубликованного поста."""
+        rows = await STORAGE.fetchall(SQL_ARCHIVE_POST, (post_id,))
+        if not rows:
+            return None
+        author_id, draft, retracted_at = rows[0]
+        return author_id, draft_from_json(draft), retracted_at
+
+    def add_messages(self, con: sqlite3.Connection, post_id: str, chat_id: int, flag: str, message_ids: str):
+        con.execute(SQL_ARCHIVE_MESSAGES_UPSERT, (post_id, chat_id, flag, message_ids))
+
+    def forget(self, con: sqlite3.Connection, post_id: str):
+        if self.fts:
+            con.execute(SQL_ARCHIVE_FTS_DELETE, (post_id,))
+        con.execute(SQL_ARCHIVE_DELETE, (post_id,))
+        con.execute(SQL_ARCHIVE_MESSAGES_DELETE, (post_id,))
+
+    async def find_by_link(self, link_hash: Optional[str]) -> Optional[Tuple[str, float]]:
+        if not link_hash:
+            return None
+        rows = await STORAGE.fetchall(SQL_ARCHIVE_BY_LINK, (link_hash,))
+        return tuple(rows[0]) if rows else None
+
+    async def search(self, query: str, limit: int = 10) -> List[Tuple[str, float, str, Optional[float]]]:
+        m = _URL_RE.search(query)
+        if m:
+            key = normalize_link(m.group(0))
+            hit = await self.find_by_link(hashlib.sha1(key.encode()).hexdigest() if key else None)
+            if not hit:
+                return []
+            return [tuple(r) for r in await STORAGE.fetchall(SQL_ARCHIVE_GET, (hit[0],))]
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        if self.fts:
+            match = " ".join(f'"{w}"*' for w in words)
+            return [tuple(r) for r in await STORAGE.fetchall(SQL_ARCHIVE_SEARCH_FTS, (match, limit))]
+        like = "%" + re.sub(r"([%_\\])", r"\\\1", " ".join(words)) + "%"
+        return [tuple(r) for r in await STORAGE.fetchall(SQL_ARCHIVE_SEARCH_LIKE, (like, like, limit))]
+
+    async def messages(self, post_id: str) -> List[Tuple[str, int, List[int]]]:
+        rows = await STORAGE.fetchall(SQL_ARCHIVE_MESSAGES, (post_id,))
+        return [(flag, chat_id, json.loads(ids)) for flag, chat_id, ids in rows]
+
+
+ARCHIVE = PostArchive()
+
+
+def duplicate_notice(e: DuplicatePost) -> str:
+    when = datetime.fromtimestamp(e.created_at, PUBLISH_ZONE).strftime("%d.%m.%Y %H:%M") if e.created_at else "ранее"
+    return f"⚠️ Объявление с этой ссылкой уже публиковалось ({when})."
+
+
+async def report_duplicate(bot: Bot, uid: int, e: DuplicatePost, action: str, cb: Optional[CallbackQuery] = None):
+    """Сообщает о дубле; админу — с кнопкой «всё равно», которая повторяет action без проверки ссылки."""
+    if not is_admin_id(uid):
+        if cb:
+            await safe_answer(cb, duplicate_notice(e), alert=True)
+        else:
+            await bot.send_message(uid, duplicate_notice(e))
+        return
+    if cb:
+        await safe_answer(cb, "Дубль")
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⚠️ Всё равно опубликовать", callback_data=f"act:{action}!")],
     ])
+    await bot.send_message(uid, duplicate_notice(e) + "\nЕсли это другое объявление, его можно опубликовать всё равно.", reply_markup=kb)
 
 
-def kbd_after_preview(d: Draft) -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton(text="✅ Опубликовать во все каналы", callback_data="act:publish")],
-        [InlineKeyboardButton(text="➕ Добавить ещё фото", callback_data="act:add_more")],
-        [InlineKeyboardButton(text="🧹 Очистить медиа", callback_data="act:clear_media")],
-    ]
-    if d.mode == "ready":
-        rows.append([InlineKeyboardButton(text="✏️ Подправить текст", callback_data="act:edit_ready")])
-    else:
-        rows.append([InlineKeyboardButton(text="✏️ Изменить поле", callback_data="act:edit_menu")])
+POST_BUSY_NOTICE = "⏳ Пост сейчас отправляется в каналы — повторите через минуту."
 
-    rows += [
-        [InlineKeyboardButton(text="🔁 Сменить режим", callback_data="act:switch_mode")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="act:cancel")],
+
+def message_link(chat_id: int, message_id: int) -> str:
+    """Ссылка на пост в канале (t.me/c/… открывается у подписчиков приватного канала)."""
+    raw = str(chat_id)
+    if not raw.startswith("-100") or len(raw) <= 4:
+        return f"#{message_id}"
+    return f"https://t.me/c/{raw[4:]}/{message_id}"
+
+
+# ---------- Edit / retract published posts ----------
+def kbd_post_actions(post_id: str, n: Optional[int] = None) -> List[InlineKeyboardButton]:
+    suffix = f" {n}" if n is not None else ""
+    return [
+        InlineKeyboardButton(text="✏️ Изменить" + suffix, callback_data=f"post:edit:{post_id}"),
+        InlineKeyboardButton(text="🗑 Снять" + suffix, callback_data=f"post:del:{post_id}"),
     ]
-    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def kbd_edit_fields() -> InlineKeyboardMarkup:
-    rows, row = [], []
-    for k, title, _ in FIELDS:
-        text = "📝 Дополнительно" if k == "extra" else title
-        row.append(InlineKeyboardButton(text=text, callback_data=f"edit:{k}"))
-        if len(row) == 2:
-            rows.append(row)
-            row = []
-    if row:
-        rows.append(row)
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="act:back_preview")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+async def for_each_channel(post_id: str, action: Callable) -> List[Tuple[str, int, List[int], str]]:
+    """action(flag, chat_id, message_ids) -> новые message_ids по всем каналам поста.
+
+    Каналы обрабатываются параллельно, не больше POST_ACTION_CONCURRENCY сразу.
+    Возвращает (флаг, chat_id, message_ids, ошибка) по каждому каналу.
+    """
+    sem = asyncio.Semaphore(max(1, POST_ACTION_CONCURRENCY))
+
+    async def one(flag: str, chat_id: int, ids: List[int]):
+        async with sem, chat_semaphore(chat_id):
+            try:
+                return flag, chat_id, await action(flag, chat_id, ids), ""
+            except Exception as e:
+                log_event("post_action_failed", chat_id=chat_id, flag=flag, post_id=post_id, error=repr(e))
+                return flag, chat_id, ids, str(e)
 
+    channels = [m for m in await ARCHIVE.messages(post_id) if m[2]]
+    return list(await asyncio.gather(*(one(*m) for m in channels)))
 
-# ---------- Render & prompts ----------
-def prompt_for(key: str) -> str:
-    _, title, example = next(x for x in FIELDS if x[0] == key)
-    if key == "extra":
-        return (
-            f"{title}\n"
-            f"— Можно добавить любые нюансы.\n"
-            f"— Если не нужно: отправьте -"
-        )
-    return f"{title}\nПример: {example}"
 
+def channel_report(title: str, results: List[Tuple[str, int, List[int], str]],
+                   queued: Sequence[str] = (), queued_note: str = "") -> str:
+    lines = [title]
+    lines += [f"{flag} ✅" if not err else f"{flag} ⚠️ {err[:200]}" for flag, _, _, err in results]
+    lines += [f"{flag} ⏳ {queued_note}" for flag in queued]
+    return "\n".join(lines) if len(lines) > 1 else title + "\n— нет сообщений в каналах"
 
-def render_wizard_post(d: Draft) -> str:
-    v = d.data
-    extra_block = ""
-    extra = (d.extra_text or "").strip()
-    if extra and extra != "-":
-        extra_block = f"\n\n📝 Дополнительно:\n{extra}"
-    return (
-        f"🚗 {v.get('brand_model', '')}\n"
-        f"💰 Стоимость: {v.get('price', '')}\n"
-        f"📅 Дата первичной регистрации: {v.get('reg_date', '')}\n"
-        f"📏 Пробег: {v.get('mileage', '')}\n"
-        f"🛠 Объём двигателя: {v.get('engine', '')}\n"
-        f"⛽️ Вид топлива: {v.get('fuel', '')}\n"
-        f"⚙️ Коробка передач: {v.get('gearbox', '')}\n"
-        f"🔋 Гибрид / Электро: {v.get('hybrid', '')}\n"
-        f"🛡 Технический осмотр: {v.get('inspection', '')}\n"
-        f"👥 Колличество владельцев: {v.get('owners', '')}\n"
-        f"🧩 Комплектация: {v.get('trim', '')}\n"
-        f"👤 Продавец: {v.get('seller', '')}\n"
-        f"📌 Прозвон. Получена подробная информация от продавца: {v.get('callcheck', '')}"
-        f"{extra_block}\n\n"
-        f"💬 Заинтересовал автомобиль?\n"
-        f"Напишите в ДИРЕКТ, чтобы получить детальный расчёт итоговой стоимости и полный обзор возможных нюансов и подводных камней при покупке этого автомобиля.\n\n"
-        f"ℹ️  Пример автомобиля, доступного к приобретению.\n"
-        f"Информация приведена на основе открытых данных объявления.\n\n"
-        f"🔗 Ссылка может быть недоступна в отдельных регионах — это связано с локальными ограничениями доступа к сайту.\n\n"
-        f"{v.get('link', '')}"
-    )
 
+def _outbox_busy(con: sqlite3.Connection, post_id: str):
+    if con.execute(SQL_OUTBOX_POST_SENDING, (post_id,)).fetchone()[0]:
+        raise PostBusy(post_id)
 
-def render_final_text(d: Draft) -> str:
-    return d.ready_text.strip() if d.mode == "ready" else render_wizard_post(d)
 
+async def apply_post_edit(bot: Bot, post_id: str, d: Draft,
+                          n_media: int) -> Tuple[List[Tuple[str, int, List[int], str]], List[str]]:
+    """Новый текст поста во всех каналах: подпись альбома, хвост текста (правка/удаление/досылка).
 
-async def send_preview(bot: Bot, user_id: int, d: Draft) -> None:
-    text = render_final_text(d)
-    kb = kbd_after_preview(d)
+    Каналы, куда пост ещё не ушёл (pending в outbox), получают новый текст прямо в очереди.
+    Возвращает (результаты по вышедшим каналам, флаги каналов из очереди).
+    """
 
-    log_event(
-        "send_preview",
-        user=None,
-        chat_id=user_id,
-        message_id=None,
-        mode=d.mode,
-        finalized=d.finalized,
-        media_count=len(d.media),
-        text_len=len(text),
-    )
+    def requeue(con: sqlite3.Connection) -> List[str]:
+        _outbox_busy(con, post_id)
+        flags = []
+        for job_id, flag in con.execute(SQL_OUTBOX_POST_QUEUED, (post_id,)).fetchall():
+            con.execute(SQL_OUTBOX_SET_TEXT, (render_final_text(d, target_code(flag)), job_id))
+            flags.append(flag)
+        return flags
 
-    if not d.media:
-        await bot.send_message(user_id, "Предпросмотр:\n\n" + text, reply_markup=kb)
-        return
+    # очередь правим до сетевых вызовов: если строка уже отправляется, в каналах ничего не меняем
+    queued = await STORAGE.transaction(requeue)
 
-    media_group = []
-    cap = ("Предпросмотр:\n\n" + text)[:1024]
-    for i, item in enumerate(d.media[:10]):
-        c = cap if i == 0 else None
-        if item["type"] == "photo":
-            media_group.append(InputMediaPhoto(media=item["file_id"], caption=c))
-        elif item["type"] == "video":
-            media_group.append(InputMediaVideo(media=item["file_id"], caption=c))
-        elif item["type"] == "document":
-            media_group.append(InputMediaDocument(media=item["file_id"], caption=c))
+    async def edit(flag: str, chat_id: int, ids: List[int]) -> List[int]:
+        text = render_final_text(d, target_code(flag))
+        if not n_media:
+            await _try_edit(bot.edit_message_text(text, chat_id=chat_id, message_id=ids[0]), raise_errors=True)
+            return ids
+        cap, rest = split_caption(text)
+        album, tail = ids[:n_media], ids[n_media:]
+        await _try_edit(bot.edit_message_caption(chat_id=chat_id, message_id=album[0], caption=cap), raise_errors=True)
+        if tail and rest.strip():
+            await _try_edit(bot.edit_message_text(rest, chat_id=chat_id, message_id=tail[0]), raise_errors=True)
+        elif tail:
+            await bot.delete_messages(chat_id=chat_id, message_ids=tail)
+            tail = []
+        elif rest.strip():
+            tail = [(await bot.send_message(chat_id, rest)).message_id]
+        return album + tail
+
+    results = await for_each_channel(post_id, edit)
+    link_hash = draft_link_hash(d)
+
+    def save(con: sqlite3.Connection):
+        ARCHIVE.update(con, post_id, d, link_hash)
+        for _, chat_id, ids, _ in results:
+            con.execute(SQL_ARCHIVE_MESSAGES_SET, (json.dumps(ids), post_id, chat_id))
+
+    await STORAGE.transaction(save)
+    return results, queued
 
-    await bot.send_media_group(chat_id=user_id, media=media_group)
-    rest = ("Предпросмотр:\n\n" + text)[1024:]
-    if rest.strip():
-        await bot.send_message(user_id, rest)
-    await bot.send_message(user_id, "Выберите действие:", reply_markup=kb)
+
+async def retract_post(bot: Bot, post_id: str) -> Tuple[List[Tuple[str, int, List[int], str]], List[str]]:
+    """Удаляет пост из каналов и снимает с очереди каналы, куда он ещё не ушёл."""
+
+    def cancel(con: sqlite3.Connection) -> List[str]:
+        _outbox_busy(con, post_id)
+        flags = [flag for _, flag in con.execute(SQL_OUTBOX_POST_QUEUED, (post_id,)).fetchall()]
+        con.execute(SQL_OUTBOX_POST_DROP, (post_id,))
+        return flags
+
+    # строки из кучи OutboxWorker не убираем: _claim пропускает удалённые
+    queued = await STORAGE.transaction(cancel)
+
+    async def delete(flag: str, chat_id: int, ids: List[int]) -> List[int]:
+        await bot.delete_messages(chat_id=chat_id, message_ids=ids)
+        return []
+
+    results = await for_each_channel(post_id, delete)
+
+    def save(con: sqlite3.Connection):
+        # удалённые каналы больше не трогаем; не удалось — id остаются для повторной попытки
+        for _, chat_id, ids, _ in results:
+            con.execute(SQL_ARCHIVE_MESSAGES_SET, (json.dumps(ids), post_id, chat_id))
+        if not any(err for *_, err in results):
+            ARCHIVE.retract(con, post_id)
+
+    await STORAGE.transaction(save)
+    return results, queued
 
 
 # ---------- Bot commands (подсказки по /) ----------
-async def setup_commands(bot: Bot):
-    # Команды для всех
-    await bot.set_my_commands(
-        commands=[
+def command_sets() -> List[Tuple[Any, List[BotCommand]]]:
+    sets = [(
+        BotCommandScopeDefault(),
+        [
             BotCommand(command="start", description="Старт / справка"),
             BotCommand(command="new", description="Создать объявление (нужен доступ)"),
             BotCommand(command="cancel", description="Отменить текущий черновик"),
         ],
-        scope=BotCommandScopeDefault()
-    )
+    )]
 
     # Команды для админа — только если admin_id задан
     if ADMIN_ID and ADMIN_ID > 0:
-        await bot.set_my_commands(
-            commands=[
+        sets.append((
+            BotCommandScopeChat(chat_id=ADMIN_ID),
+            [
                 BotCommand(command="start", description="Старт / справка"),
                 BotCommand(command="new", description="Создать объявление"),
                 BotCommand(command="cancel", description="Отменить черновик"),
-                BotCommand(command="allow", description="Выдать доступ: /allow @username"),
-                BotCommand(command="deny", description="Забрать доступ: /deny @username"),
+                BotCommand(command="allow", description="Выдать доступ: /allow @a @b или файл"),
+                BotCommand(command="deny", description="Забрать доступ: /deny @a @b или файл"),
                 BotCommand(command="list", description="Список пользователей с доступом"),
+                BotCommand(command="export", description="Выгрузить allowlist в CSV"),
+                BotCommand(command="find", description="Поиск по опубликованным постам"),
+                BotCommand(command="stats", description="Метрики бота"),
             ],
-            scope=BotCommandScopeChat(chat_id=ADMIN_ID)
-        )
+        ))
+    return sets
+
+
+def command_sets_hash(sets: List[Tuple[Any, List[BotCommand]]]) -> str:
+    payload = [
+        [scope.model_dump(mode="json"), [c.model_dump(mode="json") for c in commands]]
+        for scope, commands in sets
+    ]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+async def setup_commands(bot: Bot) -> bool:
+    """set_my_commands по всем scope, если наборы изменились с прошлого запуска.
+
+    Хэш зарегистрированных наборов хранится в meta (свой ключ на каждого бота).
+    Возвращает True, если команды отправлялись в API.
+    """
+    sets = command_sets()
+    key, digest = f"commands:{bot.id}", command_sets_hash(sets)
+    if await db_meta_get(key) == digest:
+        return False
+    for scope, commands in sets:
+        await bot.set_my_commands(commands=commands, scope=scope)
+    await db_meta_set(key, digest)
+    return True
+
+
+async def register_commands(bot: Bot):
+    """setup_commands в фоне, параллельно с первым poll: ошибка не мешает приёму апдейтов."""
+    t0 = time.perf_counter()
+    try:
+        sent = await setup_commands(bot)
+    except Exception as e:
+        logger.warning("setup_commands failed: %r", e)
+        return
+    log_event("commands_registered", sent=sent, ms=round((time.perf_counter() - t0) * 1000, 1))
 
 
 # ---------- Commands ----------
 @dp.message(Command("start"))
 async def start(m: Message):
-    db_init()
     log_event("cmd", user=m.from_user, chat_id=m.chat.id, message_id=m.message_id, command="/start")
 
-    if not has_access_user_id(m):
+    if not await has_access_user_id(m):
         await deny_access_reply(m)
         return
 
@@ -386,7 +2942,7 @@ async def start(m: Message):
 async def cancel(m: Message):
     log_event("cmd", user=m.from_user, chat_id=m.chat.id, message_id=m.message_id, command="/cancel")
 
-    if not has_access_user_id(m):
+    if not await has_access_user_id(m):
         await deny_access_reply(m)
         return
     if m.from_user:
@@ -398,7 +2954,7 @@ async def cancel(m: Message):
 async def new(m: Message):
     log_event("cmd", user=m.from_user, chat_id=m.chat.id, message_id=m.message_id, command="/new")
 
-    if not has_access_user_id(m):
+    if not await has_access_user_id(m):
         await deny_access_reply(m)
         return
 
@@ -416,42 +2972,98 @@ async def new(m: Message):
 
 
 # Команда allow
+async def bulk_allowlist(m: Message, bot: Bot, action: str, tokens: List[str]):
+    """/allow и /deny со списком username или файлом: одна транзакция на всю пачку."""
+    if m.document:
+        if (m.document.file_size or 0) > ALLOWLIST_IMPORT_MAX_BYTES:
+            await m.answer("Файл слишком большой.")
+            return
+        buf = io.BytesIO()
+        await bot.download(m.document, destination=buf)
+        tokens = tokens + usernames_from_file(buf.getvalue())
+
+    usernames, bad = parse_usernames(tokens)
+    if not usernames:
+        await m.answer("Не нашёл ни одного username. Пример: /" + action + " @user1 @user2")
+        return
+
+    if action == "allow":
+        changed, waiting = await db_allow_many(usernames)
+        head = f"✅ Доступ выдан: {changed}" + (f" (уже были: {len(usernames) - changed})" if changed < len(usernames) else "")
+    else:
+        changed, waiting = await db_deny_many(usernames), 0
+        head = f"❌ Доступ убран: {changed}" + (f" (не было в списке: {len(usernames) - changed})" if changed < len(usernames) else "")
+    if len(usernames) == 1 and not bad:
+        head += f" — {fmt_user_key(usernames[0])}"
+    if waiting:
+        head += f"\n⏳ Ещё не писали боту: {waiting} — доступ привяжется к id при первом сообщении"
+    if bad:
+        head += "\n⚠️ Пропущены: " + " ".join(bad[:20]) + (" …" if len(bad) > 20 else "")
+    log_event("allowlist_bulk", user=m.from_user, chat_id=m.chat.id, action=action, total=len(usernames),
+              changed=changed, skipped=len(bad))
+    await m.answer(head)
+
+
 @dp.message(Command("allow"))
-async def allow(m: Message):
+async def allow(m: Message, bot: Bot):
     if not m.from_user or not is_admin_id(m.from_user.id):
         await m.answer("⛔️ У вас нет доступа к этой команде.")
         return
 
-    parts = (m.text or "").split()
-    if len(parts) == 1:
+    parts = (m.text or m.caption or "").split()
+    if len(parts) == 1 and not m.document:
         ADMIN_PENDING[m.from_user.id] = "allow"
-        await m.answer("Введите username для доступа. Пример: @username")
+        await m.answer("Введите username для доступа (можно несколько через пробел). Пример: @username")
         return
 
-    u = parts[1].lstrip("@").lower().strip()
-    if not u:
-        await m.answer("Укажите username.")
-        return
-    db_allow(u)
-    await m.answer(f"✅ Доступ выдан: @{u}")
+    await bulk_allowlist(m, bot, "allow", parts[1:])
 
 
 # Команда deny
 @dp.message(Command("deny"))
-async def deny(m: Message):
+async def deny(m: Message, bot: Bot):
     if not m.from_user or not is_admin_id(m.from_user.id):
         await m.answer("⛔️ У вас нет доступа к этой команде.")
         return
 
-    parts = (m.text or "").split()
-    if len(parts) == 1:
+    parts = (m.text or m.caption or "").split()
+    if len(parts) == 1 and not m.document:
         ADMIN_PENDING[m.from_user.id] = "deny"
-        await m.answer("Введите username для забора доступа. Пример: @username")
+        await m.answer("Введите username для забора доступа (можно несколько через пробел). Пример: @username")
         return
 
-    u = parts[1].lstrip("@").lower().strip()
-    db_deny(u)
-    await m.answer(f"❌ Доступ убран: @{u}")
+    await bulk_allowlist(m, bot, "deny", parts[1:])
+
+
+# Файл после /allow или /deny без аргумента — как /allow <файл>; раньше медиа-хендлеров,
+# иначе CSV уйдёт во вложения открытого черновика
+@dp.message(F.document, F.from_user.func(lambda u: is_admin_id(u.id) and u.id in ADMIN_PENDING))
+async def admin_pending_file(m: Message, bot: Bot):
+    action = ADMIN_PENDING.get(m.from_user.id)
+    log_event("admin_pending_file", user=m.from_user, chat_id=m.chat.id, message_id=m.message_id,
+              action=action, file_name=m.document.file_name)
+    await bulk_allowlist(m, bot, action, (m.caption or "").split())
+    ADMIN_PENDING.pop(m.from_user.id, None)
+
+
+async def render_allowed_page(after: int = 0, before: Optional[int] = None):
+    items, has_prev, has_next = await db_allowed_page(after, before)
+    first_page = not after and before is None
+    pending = sorted(ALLOWED_PENDING) if first_page else []
+    if not items and not pending:
+        return "❌ Список пуст.", None
+    total = (await STORAGE.fetchall(SQL_ALLOWED_COUNT))[0][0]
+    lines = [f"✅ Пользователи с доступом ({total}):"]
+    lines += [f"@{name} · {uid}" if name else f"id {uid}" for uid, name in items]
+    if pending:
+        shown = " ".join(f"@{u}" for u in pending[:50]) + (f" … и ещё {len(pending) - 50}" if len(pending) > 50 else "")
+        lines.append(f"\n⏳ Ещё не писали боту ({len(pending)}): {shown}")
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"list:<:{items[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Дальше ▶️", callback_data=f"list:>:{items[-1][0]}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
 
 
 @dp.message(Command("list"))
@@ -459,15 +3071,172 @@ async def list_allowed(m: Message):
     if not m.from_user or not is_admin_id(m.from_user.id):
         await m.answer("⛔️ У вас нет доступа к этой команде.")
         return
-    items = db_list_allowed()
-    if not items:
-        await m.answer("❌ Список пуст.")
+    text, kb = await render_allowed_page()
+    await m.answer(text, reply_markup=kb)
+
+
+@dp.message(Command("export"))
+async def export_allowed(m: Message):
+    if not m.from_user or not is_admin_id(m.from_user.id):
+        await m.answer("⛔️ У вас нет доступа к этой команде.")
+        return
+    import csv
+
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    allowed, pending = await db_list_allowed()
+    w.writerow(["user_id", "username"])
+    w.writerows([uid, name or ""] for uid, name in allowed)
+    w.writerows(["", name] for name in pending)
+    await m.answer_document(
+        BufferedInputFile(buf.getvalue().encode("utf-8"), filename="allowlist.csv"),
+        caption="Allowlist. Импорт: отправьте файл с подписью /allow или /deny.",
+    )
+
+
+@dp.message(Command("find"))
+async def find_posts(m: Message):
+    if not m.from_user or not is_admin_id(m.from_user.id):
+        await m.answer("⛔️ У вас нет доступа к этой команде.")
+        return
+    query = (m.text or "").partition(" ")[2].strip()
+    if not query:
+        await m.answer("Поиск по опубликованным постам: /find kia sportage или /find <ссылка на объявление>")
+        return
+
+    t0 = time.perf_counter()
+    found = await ARCHIVE.search(query)
+    elapsed = (time.perf_counter() - t0) * 1000
+    if not found:
+        await m.answer(f"🔎 Ничего не найдено ({elapsed:.0f} мс).")
+        return
+
+    lines = [f"🔎 Найдено: {len(found)} ({elapsed:.0f} мс)"]
+    buttons = []
+    for n, (post_id, created_at, text, retracted_at) in enumerate(found, 1):
+        when = datetime.fromtimestamp(created_at, PUBLISH_ZONE).strftime("%d.%m.%Y")
+        title = text.strip().split("\n", 1)[0][:80]
+        if retracted_at:
+            links = "🗑 снят"
+        else:
+            links = " · ".join(
+                f"{flag} {message_link(chat_id, ids[0])}" for flag, chat_id, ids in await ARCHIVE.messages(post_id) if ids
+            ) or "— ещё не вышел"
+            buttons.append(kbd_post_actions(post_id, n))
+        lines.append(f"\n{n}) {when} · {title}\n{links}")
+    kb = InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
+    await m.answer("\n".join(lines), reply_markup=kb, disable_web_page_preview=True)
+
+
+@dp.message(Command("stats"))
+async def stats(m: Message):
+    if not m.from_user or not is_admin_id(m.from_user.id):
+        await m.answer("⛔️ У вас нет доступа к этой команде.")
         return
-    await m.answer("✅ Список пользователей с доступом:\n" + "\n".join(f"@{u}" for u in items))
+    await m.answer("📊 Статистика:\n" + (METRICS.render_text() or "пока пусто"))
 
 
 # ---------- CALLBACKS ----------
 
+async def _post_for_action(cb: CallbackQuery, post_id: str) -> Optional[Tuple[int, Draft, Optional[float]]]:
+    """Пост из архива, если его можно трогать этому пользователю (админ или автор с доступом)."""
+    post = await ARCHIVE.get(post_id)
+    if post is None:
+        await safe_answer(cb, "Пост не найден.", alert=True)
+        return None
+    uid = cb.from_user.id
+    if not (is_admin_id(uid) or (post[0] == uid and await has_access_cb(cb))):
+        await safe_answer(cb, "⛔️ Нет доступа", alert=True)
+        return None
+    if post[2]:
+        await safe_answer(cb, "Пост уже снят из каналов.", alert=True)
+        return None
+    return post
+
+
+@dp.callback_query(F.data.startswith("post:"))
+async def on_post_action(cb: CallbackQuery, bot: Bot):
+    log_event("callback", user=cb.from_user, chat_id=cb.from_user.id, cb_data=cb.data)
+    _, action, post_id = cb.data.split(":", 2)
+    post = await _post_for_action(cb, post_id)
+    if post is None:
+        return
+    uid = cb.from_user.id
+
+    if action in ("edit", "edit!"):
+        current = DRAFTS.get(uid)
+        if action == "edit" and current is not None and current.editing_post != post_id:
+            kb = InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="✏️ Да, заменить", callback_data=f"post:edit!:{post_id}"),
+                InlineKeyboardButton(text="Нет", callback_data=f"post:keep:{post_id}"),
+            ]])
+            await safe_answer(cb)
+            await bot.send_message(
+                uid,
+                "У вас есть незавершённый черновик. Заменить его правкой опубликованного поста? "
+                "Черновик будет удалён.",
+                reply_markup=kb,
+            )
+            return
+        d = post[1]
+        d.editing_post = post_id
+        d.finalized = True
+        d.step = len(FIELDS)
+        d.awaiting_edit_field = None
+        d.awaiting_ready_text = False
+        d.awaiting_schedule = False
+        d.preview = {}
+        d.touch()
+        DRAFTS[uid] = d
+        await safe_answer(cb, "Ок")
+        await bot.send_message(uid, "✏️ Правка опубликованного поста. Измените текст и нажмите «Обновить во всех каналах».")
+        await PREVIEWS.now(bot, uid, d)
+        return
+
+    if action == "del":
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="🗑 Да, снять", callback_data=f"post:del!:{post_id}"),
+            InlineKeyboardButton(text="Нет", callback_data=f"post:keep:{post_id}"),
+        ]])
+        await safe_answer(cb)
+        await bot.send_message(uid, "Снять пост из всех каналов?", reply_markup=kb)
+        return
+
+    if action == "keep":
+        await safe_answer(cb, "Ок")
+        await _try_edit(cb.message.edit_text("Ок, ничего не меняю."))
+        return
+
+    if action == "del!":
+        await safe_answer(cb, "Снимаю…")
+        try:
+            results, queued = await retract_post(bot, post_id)
+        except PostBusy:
+            await _try_edit(cb.message.edit_text(POST_BUSY_NOTICE))
+            return
+        log_event("post_retracted", user=cb.from_user, chat_id=uid, post_id=post_id,
+                  failed=[flag for flag, *_, err in results if err], dequeued=queued)
+        await _try_edit(cb.message.edit_text(
+            channel_report("🗑 Пост снят:", results, queued, "ещё не вышел — убран из очереди")))
+        return
+
+    await safe_answer(cb, "Неизвестное действие.", alert=True)
+
+
+@dp.callback_query(F.data.startswith("list:"))
+async def on_list_page(cb: CallbackQuery):
+    if not is_admin_id(cb.from_user.id):
+        await safe_answer(cb, "⛔️ Нет доступа", alert=True)
+        return
+    _, direction, key = cb.data.split(":", 2)
+    if direction == "<":
+        text, kb = await render_allowed_page(before=int(key))
+    else:
+        text, kb = await render_allowed_page(after=int(key))
+    await _try_edit(cb.message.edit_text(text, reply_markup=kb))
+    await safe_answer(cb)
+
+
 @dp.callback_query(F.data.startswith("new:"))
 async def on_new_mode(cb: CallbackQuery):
     log_event(
@@ -478,7 +3247,7 @@ async def on_new_mode(cb: CallbackQuery):
         cb_data=cb.data,
     )
 
-    if not has_access_cb(cb):
+    if not await has_access_cb(cb):
         await safe_answer(cb, "⛔️ Нет доступа", alert=True)
         return
 
@@ -507,6 +3276,7 @@ async def on_new_mode(cb: CallbackQuery):
         d.ready_text = ""
         d.data.clear()
         d.extra_text = ""
+        d.touch()
         log_event("draft_mode_set", user=cb.from_user, mode="ready")
         await cb.message.edit_text(
             "Ок. Вставьте ГОТОВЫЙ текст объявления одним сообщением.\n\n"
@@ -522,6 +3292,7 @@ async def on_new_mode(cb: CallbackQuery):
         d.ready_text = ""
         d.data.clear()
         d.extra_text = ""
+        d.touch()
         first_key = FIELDS[0][0]
         log_event("draft_mode_set", user=cb.from_user, mode="wizard")
         await cb.message.edit_text(
@@ -537,7 +3308,7 @@ async def on_new_mode(cb: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("act:"))
 async def on_act(cb: CallbackQuery, bot: Bot):
-    if not has_access_cb(cb):
+    if not await has_access_cb(cb):
         await safe_answer(cb, "⛔️ Нет доступа", alert=True)
         return
 
@@ -548,6 +3319,18 @@ async def on_act(cb: CallbackQuery, bot: Bot):
         return
 
     action = cb.data.split(":", 1)[1]
+    if action.endswith("!"):
+        # «всё равно опубликовать» из report_duplicate
+        if not is_admin_id(uid):
+            await safe_answer(cb, "⛔️ Только для админа", alert=True)
+            return
+        action = action[:-1]
+        d.allow_duplicate = True
+    if action != "schedule":
+        d.awaiting_schedule = False  # любая другая кнопка отменяет ввод времени
+    if d.editing_post and action in ("publish", "schedule", "add_more", "clear_media", "switch_mode"):
+        await safe_answer(cb, "Недоступно при правке опубликованного поста.", alert=True)
+        return
 
     if action == "add_more":
         await safe_answer(cb, "Ок")
@@ -559,7 +3342,7 @@ async def on_act(cb: CallbackQuery, bot: Bot):
         await safe_answer(cb, "Медиа очищено.")
         await bot.send_message(uid, "🧹 Медиа очищено. Можете прикрепить новые фото/альбом.")
         if d.finalized:
-            await send_preview(bot, uid, d)
+            PREVIEWS.request(bot, uid)
         return
 
     if action == "edit_ready":
@@ -584,8 +3367,11 @@ async def on_act(cb: CallbackQuery, bot: Bot):
         d.ready_text = ""
         d.data.clear()
         d.extra_text = ""
+        d.touch()
         d.awaiting_edit_field = None
         d.awaiting_ready_text = False
+        d.awaiting_schedule = False
+        d.preview = {}
         await cb.message.edit_text("Выберите режим создания:", reply_markup=kbd_new_mode())
         await safe_answer(cb, "Ок")
         return
@@ -597,6 +3383,7 @@ async def on_act(cb: CallbackQuery, bot: Bot):
         if not d.finalized:
             await safe_answer(cb, "Сначала сформируйте предпросмотр.", alert=True)
             return
+        preview_kbd_touched(d, cb.message)
         await cb.message.edit_text("Что изменить?", reply_markup=kbd_edit_fields())
         await safe_answer(cb, "Ок")
         return
@@ -605,8 +3392,12 @@ async def on_act(cb: CallbackQuery, bot: Bot):
         if not d.finalized:
             await safe_answer(cb, "Сначала сформируйте предпросмотр.", alert=True)
             return
-        await cb.message.edit_text("Ок. Предпросмотр отправляю ещё раз.")
-        await send_preview(bot, uid, d)
+        if d.preview:
+            # меню полей висит на сообщении предпросмотра — вернём его на место
+            preview_kbd_touched(d, cb.message)
+        else:
+            await cb.message.edit_text("Ок. Предпросмотр отправляю ещё раз.")
+        await PREVIEWS.now(bot, uid, d)
         await safe_answer(cb, "Ок")
         return
 
@@ -615,35 +3406,55 @@ async def on_act(cb: CallbackQuery, bot: Bot):
             await safe_answer(cb, "Сначала сформируйте предпросмотр.", alert=True)
             return
 
-        text = render_final_text(d)
-        published_flags = []
-
-        for flag, chat_id in targets():
-            if d.media:
-                media_group = []
-                cap = text[:1024]
-                for i, item in enumerate(d.media[:10]):
-                    c = cap if i == 0 else None
-                    if item["type"] == "photo":
-                        media_group.append(InputMediaPhoto(media=item["file_id"], caption=c))
-                    elif item["type"] == "video":
-                        media_group.append(InputMediaVideo(media=item["file_id"], caption=c))
-                    elif item["type"] == "document":
-                        media_group.append(InputMediaDocument(media=item["file_id"], caption=c))
-
-                await bot.send_media_group(chat_id=chat_id, media=media_group)
-                rest = text[1024:]
-                if rest.strip():
-                    await bot.send_message(chat_id, rest)
-            else:
-                await bot.send_message(chat_id, text)
-
-            published_flags.append(flag)
+        try:
+            post_id = await enqueue_draft(uid, d)
+        except DuplicatePost as e:
+            log_event("publish_duplicate", user=cb.from_user, chat_id=uid, post_id=e.post_id)
+            await report_duplicate(bot, uid, e, action, cb)
+            return
+        log_event("publish_enqueued", user=cb.from_user, chat_id=uid, post_id=post_id)
 
         DRAFTS.pop(uid, None)
-        await cb.message.edit_text("Опубликовано.")
-        await bot.send_message(uid, "Добавлен пост в каналы: " + " ".join(published_flags))
         await safe_answer(cb, "Готово")
+        await cb.message.edit_text("⏳ Пост поставлен в очередь публикации. Пришлю отчёт, когда он выйдет в каналах.")
+        return
+
+    if action == "apply_edit":
+        post = await ARCHIVE.get(d.editing_post) if d.editing_post else None
+        if post is None or post[2]:
+            await safe_answer(cb, "Пост не найден или уже снят.", alert=True)
+            return
+        dup = await ARCHIVE.find_by_link(draft_link_hash(d))
+        if dup and dup[0] != d.editing_post:
+            await report_duplicate(bot, uid, DuplicatePost(*dup), action, cb)
+            return
+        await safe_answer(cb, "Обновляю…")
+        post_id = d.editing_post
+        try:
+            results, queued = await apply_post_edit(bot, post_id, d, len(post[1].media[:10]))
+        except PostBusy:
+            # колбэк уже отвечен «Обновляю…»; превью оставляем, чтобы применить правку ещё раз
+            await cb.message.answer(POST_BUSY_NOTICE)
+            return
+        log_event("post_edited", user=cb.from_user, chat_id=uid, post_id=post_id,
+                  failed=[flag for flag, *_, err in results if err], requeued=queued)
+        DRAFTS.pop(uid, None)
+        preview_kbd_touched(d, cb.message)
+        await _try_edit(cb.message.edit_text(
+            channel_report("✏️ Пост обновлён:", results, queued, "ещё не вышел — выйдет с новым текстом")))
+        return
+
+    if action == "schedule":
+        if not d.finalized:
+            await safe_answer(cb, "Сначала сформируйте предпросмотр.", alert=True)
+            return
+        dup = await ARCHIVE.find_by_link(draft_link_hash(d))
+        if dup:
+            await report_duplicate(bot, uid, DuplicatePost(*dup), action, cb)
+            return
+        d.awaiting_schedule = True
+        await safe_answer(cb, "Ок")
+        await bot.send_message(uid, SCHEDULE_PROMPT)
         return
 
     await safe_answer(cb, "Неизвестное действие.", alert=True)
@@ -659,7 +3470,7 @@ async def on_edit_field(cb: CallbackQuery):
         cb_data=cb.data,
     )
 
-    if not has_access_cb(cb):
+    if not await has_access_cb(cb):
         await safe_answer(cb, "⛔️ Нет доступа", alert=True)
         return
 
@@ -675,8 +3486,10 @@ async def on_edit_field(cb: CallbackQuery):
 
     field_key = cb.data.split(":", 1)[1]
     d.awaiting_edit_field = field_key
+    d.awaiting_schedule = False
     d.finalized = False  # вернёмся к заполнению (одно поле)
 
+    preview_kbd_touched(d, cb.message)
     await cb.message.edit_text("Введите новое значение:\n\n" + prompt_for(field_key))
     await safe_answer(cb, "Ок")
 
@@ -705,33 +3518,28 @@ async def on_text(m: Message, bot: Bot):
             raw=raw[:200],
         )
 
-        u = raw.lstrip("@").lower().strip()
-        if not u or " " in u:
-            await m.answer("Нужен один username. Пример: @username\n/cancel — отмена")
+        usernames, _ = parse_usernames(raw.split())
+        if not usernames:
+            await m.answer("Нужен username. Пример: @username\n/cancel — отмена")
             return
 
-        if action == "allow":
-            db_allow(u)
-            await m.answer(f"✅ Доступ выдан: @{u}")
-        else:
-            db_deny(u)
-            await m.answer(f"❌ Доступ убран: @{u}")
-
+        await bulk_allowlist(m, bot, action, raw.split())
         ADMIN_PENDING.pop(m.from_user.id, None)
         return
     # -----------------------------------------------
 
+    allowed = await has_access_user_id(m)
     log_event(
         "text_in",
         user=m.from_user,
         chat_id=m.chat.id,
         message_id=m.message_id,
-        allowed=has_access_user_id(m),
+        allowed=allowed,
         has_draft=bool(m.from_user and m.from_user.id in DRAFTS),
         text=m.text[:200],
     )
 
-    if not has_access_user_id(m):
+    if not allowed:
         return
 
     if not m.from_user or m.from_user.id not in DRAFTS:
@@ -741,11 +3549,30 @@ async def on_text(m: Message, bot: Bot):
     d = DRAFTS[uid]
     text = (m.text or "").strip()
 
+    if d.awaiting_schedule:
+        when = parse_publish_time(text)
+        if when is None:
+            await m.answer(f"Не понял время (или оно в прошлом / дальше {SCHEDULE_MAX_DAYS} дн.).\n\n" + SCHEDULE_PROMPT)
+            return
+        at = await OUTBOX.free_slot(when.timestamp())
+        try:
+            post_id = await enqueue_draft(uid, d, at=at)
+        except DuplicatePost as e:
+            d.awaiting_schedule = False
+            await report_duplicate(bot, uid, e, "schedule")
+            return
+        log_event("publish_scheduled", user=m.from_user, chat_id=uid, post_id=post_id, at=at)
+        DRAFTS.pop(uid, None)
+        shown = datetime.fromtimestamp(at, PUBLISH_ZONE).strftime("%d.%m.%Y %H:%M")
+        await m.answer(f"🕒 Пост запланирован на {shown}. Пришлю отчёт, когда он выйдет в каналах.")
+        return
+
     if d.awaiting_ready_text:
         d.awaiting_ready_text = False
         d.ready_text = text
+        d.touch()
         d.finalized = True
-        await send_preview(bot, uid, d)
+        await PREVIEWS.now(bot, uid, d)
         return
 
     if d.awaiting_edit_field:
@@ -755,8 +3582,9 @@ async def on_text(m: Message, bot: Bot):
             d.extra_text = text
         else:
             d.data[key] = text
+        d.touch()
         d.finalized = True
-        await send_preview(bot, uid, d)
+        await PREVIEWS.now(bot, uid, d)
         return
 
     if not d.mode:
@@ -765,8 +3593,9 @@ async def on_text(m: Message, bot: Bot):
 
     if d.mode == "ready":
         d.ready_text = text
+        d.touch()
         d.finalized = True
-        await send_preview(bot, uid, d)
+        await PREVIEWS.now(bot, uid, d)
         return
 
     if d.mode == "wizard":
@@ -779,6 +3608,7 @@ async def on_text(m: Message, bot: Bot):
             d.extra_text = text
         else:
             d.data[key] = text
+        d.touch()
 
         log_event("wizard_step_value", user=m.from_user, chat_id=m.chat.id, step=d.step, field=key)
 
@@ -789,94 +3619,167 @@ async def on_text(m: Message, bot: Bot):
 
         d.finalized = True
         log_event("wizard_finalized", user=m.from_user, chat_id=m.chat.id, total_fields=len(FIELDS))
-        await send_preview(bot, uid, d)
+        await PREVIEWS.now(bot, uid, d)
         return
 
 
 # ---------- Media handlers ----------
-@dp.message(F.media_group_id)
-async def handle_album(m: Message, bot: Bot):
-    if not has_access_user_id(m):
-        return
-    if not m.from_user or m.from_user.id not in DRAFTS:
-        return
-
-    log_event(
-        "media_album_piece",
-        user=m.from_user,
-        chat_id=m.chat.id,
-        message_id=m.message_id,
-        media_group_id=m.media_group_id,
-        has_photo=bool(m.photo),
-        has_video=bool(m.video),
-        has_document=bool(m.document),
-    )
+def media_item(m: Message) -> Optional[dict]:
+    if m.photo:
+        return {"type": "photo", "file_id": m.photo[-1].file_id}
+    if m.video:
+        return {"type": "video", "file_id": m.video.file_id}
+    if m.document:
+        return {"type": "document", "file_id": m.document.file_id}
+    return None
 
-    uid = m.from_user.id
-    key = (uid, m.media_group_id)
-    MEDIA_GROUPS.setdefault(key, []).append(m)
 
-    async def finalize():
-        await asyncio.sleep(1.0)
-        msgs = MEDIA_GROUPS.pop(key, [])
-        if not msgs:
+@dataclass
+class AlbumBuffer:
+    items: List[Tuple[int, dict]]  # (message_id, media item)
+    first_at: float
+    last_at: float
+    gap: float = 0.0  # сглаженный интервал между кусками
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class AlbumAggregator:
+    """Сборка альбомов: один таймер на (uid, media_group_id) вместо задачи на каждый кусок.
+
+    Каждый новый кусок перезапускает таймер. Тишина адаптивная: пока куски
+    идут, ждём ~3 сглаженных интервала между ними (в пределах
+    ALBUM_QUIET_MIN_MS..ALBUM_QUIET_MS), ALBUM_MAX_WAIT_MS от первого куска —
+    жёсткий потолок. В буфере только file_id; по таймеру они сразу уходят в Draft.
+    """
+
+    def __init__(self, buffers: Dict[Tuple[int, str], AlbumBuffer]):
+        self.buffers = buffers
+        self._tasks: Set[asyncio.Task] = set()
+
+    def add(self, bot: Bot, uid: int, group_id: str, message_id: int, item: dict):
+        key = (uid, group_id)
+        now = time.monotonic()
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = self.buffers[key] = AlbumBuffer(items=[], first_at=now, last_at=now)
+        else:
+            gap = now - buf.last_at
+            buf.gap = gap if not buf.gap else 0.5 * buf.gap + 0.5 * gap
+            buf.last_at = now
+            if buf.timer:
+                buf.timer.cancel()
+        buf.items.append((message_id, item))
+
+        if buf.gap:
+            quiet = min(max(3 * buf.gap, ALBUM_QUIET_MIN_MS / 1000), ALBUM_QUIET_MS / 1000)
+        else:
+            quiet = ALBUM_QUIET_MS / 1000
+        delay = min(quiet, buf.first_at + ALBUM_MAX_WAIT_MS / 1000 - now)
+        buf.timer = asyncio.get_running_loop().call_later(max(0.0, delay), self._fire, bot, key)
+
+    def _fire(self, bot: Bot, key: Tuple[int, str]):
+        task = asyncio.create_task(self._flush(bot, key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @property
+    def pending(self) -> int:
+        return len(self.buffers) + len(self._tasks)
+
+    def flush_all(self, bot: Bot):
+        """Остановка: не ждём тишины, все недособранные альбомы уходят в черновики сейчас."""
+        for key, buf in list(self.buffers.items()):
+            if buf.timer:
+                buf.timer.cancel()
+            self._fire(bot, key)
+
+    async def _flush(self, bot: Bot, key: Tuple[int, str]):
+        async with user_lock(key[0]):
+            await self._flush_locked(bot, key)
+
+    async def _flush_locked(self, bot: Bot, key: Tuple[int, str]):
+        buf = self.buffers.pop(key, None)
+        if not buf or not buf.items:
             return
+        uid, group_id = key
         d = DRAFTS.get(uid)
         if not d:
             return
-        msgs.sort(key=lambda x: x.message_id)
-
-        added = 0
-        for mm in msgs:
-            if mm.photo:
-                d.media.append({"type": "photo", "file_id": mm.photo[-1].file_id})
-                added += 1
-            elif mm.video:
-                d.media.append({"type": "video", "file_id": mm.video.file_id})
-                added += 1
-            elif mm.document:
-                d.media.append({"type": "document", "file_id": mm.document.file_id})
-                added += 1
 
+        buf.items.sort(key=lambda x: x[0])
+        d.media.extend(item for _, item in buf.items)
         d.media = d.media[:10]
+        DRAFTS.mark_dirty(uid)
 
         log_event(
             "media_album_finalized",
-            user=msgs[0].from_user if msgs else None,
-            chat_id=msgs[0].chat.id if msgs else None,
-            message_id=msgs[0].message_id if msgs else None,
-            media_group_id=m.media_group_id,
-            added=added,
+            chat_id=uid,
+            message_id=buf.items[0][0],
+            media_group_id=group_id,
+            added=len(buf.items),
             total_media=len(d.media),
+            wait_ms=round((time.monotonic() - buf.first_at) * 1000),
         )
 
         await bot.send_message(uid, "✅ Альбом добавлен.")
         if d.finalized:
-            await send_preview(bot, uid, d)
+            PREVIEWS.request(bot, uid)
+
+
+ALBUMS = AlbumAggregator(MEDIA_GROUPS)
+
+EDIT_MEDIA_NOTICE = "При правке опубликованного поста медиа не меняются — только текст."
+_EDIT_MEDIA_WARNED: Set[Tuple[int, str]] = set()  # альбомы, на которые уже ответили
+
+
+@dp.message(F.media_group_id)
+async def handle_album(m: Message, bot: Bot):
+    if not await has_access_user_id(m):
+        return
+    if not m.from_user or m.from_user.id not in DRAFTS:
+        return
+    if DRAFTS[m.from_user.id].editing_post:
+        key = (m.from_user.id, m.media_group_id)
+        if key not in _EDIT_MEDIA_WARNED:
+            if len(_EDIT_MEDIA_WARNED) > 1000:
+                _EDIT_MEDIA_WARNED.clear()
+            _EDIT_MEDIA_WARNED.add(key)
+            await m.answer(EDIT_MEDIA_NOTICE)
+        return
+
+    log_event(
+        "media_album_piece",
+        user=m.from_user,
+        chat_id=m.chat.id,
+        message_id=m.message_id,
+        media_group_id=m.media_group_id,
+        has_photo=bool(m.photo),
+        has_video=bool(m.video),
+        has_document=bool(m.document),
+    )
 
-    asyncio.create_task(finalize())
+    item = media_item(m)
+    if item:
+        ALBUMS.add(bot, m.from_user.id, m.media_group_id, m.message_id, item)
 
 
 @dp.message(F.photo | F.video | F.document)
 async def handle_single_media(m: Message, bot: Bot):
-    if not has_access_user_id(m):
+    if not await has_access_user_id(m):
         return
     if not m.from_user or m.from_user.id not in DRAFTS:
         return
 
     uid = m.from_user.id
     d = DRAFTS[uid]
+    if d.editing_post:
+        await m.answer(EDIT_MEDIA_NOTICE)
+        return
 
-    kind = "unknown"
-    if m.photo:
-        d.media.append({"type": "photo", "file_id": m.photo[-1].file_id})
-        kind = "photo"
-    elif m.video:
-        d.media.append({"type": "video", "file_id": m.video.file_id})
-        kind = "video"
-    elif m.document:
-        d.media.append({"type": "document", "file_id": m.document.file_id})
-        kind = "document"
+    item = media_item(m)
+    if item:
+        d.media.append(item)
+    kind = item["type"] if item else "unknown"
 
     d.media = d.media[:10]
 
@@ -892,21 +3795,376 @@ async def handle_single_media(m: Message, bot: Bot):
 
     await m.answer("✅ Медиа добавлено.")
     if d.finalized:
-        await send_preview(bot, uid, d)
+        PREVIEWS.request(bot, uid)
 
 
 # ---------- Main ----------
+async def run_webhook(bot: Bot):
+    """Webhook через локальный aiohttp: проверка секрета, мгновенный 200, апдейт — в фоновую задачу."""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    log_event("webhook_started", host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+# ---------- Lifecycle ----------
+class Lifecycle:
+    """Фоновые задачи процесса и мягкая остановка.
+
+    service() — бесконечные циклы (флашер, рефрешер): при остановке отменяются.
+    spawn() — разовая работа: при остановке её дожидаемся (в пределах дедлайна).
+    """
+
+    def __init__(self):
+        self.stopping = False
+        self._services: Set[asyncio.Task] = set()
+        self._work: Set[asyncio.Task] = set()
+
+    def service(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._services.add(task)
+        task.add_done_callback(self._services.discard)
+        return task
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._work.add(task)
+        task.add_done_callback(self._work.discard)
+        return task
+
+    def busy(self) -> bool:
+        """Есть незавершённая работа: апдейты в обработке/очереди, альбомы, предпросмотры, spawn()."""
+        return bool(_updates_in_flight or len(USER_LOCKS) or ALBUMS.pending or PREVIEWS.pending or self._work)
+
+    async def shutdown(self, bot: Bot, timeout: float = SHUTDOWN_TIMEOUT):
+        """Приём апдейтов уже остановлен. Доделываем начатое до дедлайна, сохраняем состояние.
+
+        1) альбомы собираются сразу, отложенные предпросмотры отправляются;
+        2) ждём хендлеры и фоновую работу;
+        3) outbox доделывает начатые и созревшие строки, остальное ждёт в bot.db;
+        4) черновики -> STATE, закрываем БД, дописываем логи.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        t0 = time.monotonic()
+        deadline = t0 + timeout
+        log_event("shutdown_started", timeout=timeout, albums=len(MEDIA_GROUPS), in_flight=_updates_in_flight)
+
+        ALBUMS.flush_all(bot)
+        PREVIEWS.flush_all(bot)
+        while self.busy() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        drained = not self.busy()
+        await OUTBOX.stop(max(0.0, deadline - time.monotonic()))
+
+        for task in (*self._services, *self._work):
+            task.cancel()
+        await asyncio.gather(*self._services, *self._work, return_exceptions=True)
+        await DRAFTS.flush()
+        await ADMIN_PENDING.flush()
+        await STATE.close()
+        await STORAGE.close()
+        log_event("shutdown_done", drained=drained, ms=round((time.monotonic() - t0) * 1000))
+        stop_logging()
+
+
+LIFECYCLE = Lifecycle()
+
+
+async def start_worker() -> Bot:
+    """Поднимает всё, что нужно для обработки апдейтов: БД, шаблоны, бота, фоновые задачи."""
+    await db_init()
+    load_templates()
+    if PUBLISH_ZONE_WARNING:
+        logger.warning(PUBLISH_ZONE_WARNING)
+    bot = Bot(BOT_TOKEN, session=SplitSession())
+    bot.session.middleware(RATE_LIMITER)
+    bot.session.middleware(API_METRICS)
+
+    if ALLOWLIST_TTL > 0:
+        LIFECYCLE.service(allowlist_refresher())
+    LIFECYCLE.service(state_flusher())
+    await OUTBOX.start(bot)
+    if METRICS_PORT:
+        await start_metrics_server()
+    return bot
+
+
+async def stop_worker(bot: Bot):
+    """Мягкая остановка воркера; сессию бота закрывает вызывающий — после неё."""
+    await LIFECYCLE.shutdown(bot)
+
+
 async def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN пуст")
 
-    db_init()
-    bot = Bot(BOT_TOKEN)
-    await setup_commands(bot)
+    bot = await start_worker()
+    LIFECYCLE.spawn(register_commands(bot))
+
+    log_event("bot_started", user=None, chat_id=None, message_id=None, mode=BOT_MODE)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot)
+        else:
+            # SIGTERM/SIGINT останавливают только приём; сессия нужна для досылки при остановке
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await stop_worker(bot)
+        await bot.session.close()
+
+
+# ---------- Sharding: один процесс приёма + N воркеров ----------
+def shard_of(update: dict, shards: int) -> int:
+    """Воркер для апдейта: по id пользователя, чтобы мастер, альбомы и ожидание админа
+    одного пользователя всегда жили в одном процессе."""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user:
+                return user["id"] % shards
+    return update.get("update_id", 0) % shards
+
+
+async def shard_worker_main(updates: "multiprocessing.Queue"):
+    bot = await start_worker()
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    get = functools.partial(updates.get, timeout=0.5)
+    tasks: Set[asyncio.Task] = set()
+
+    log_event("shard_started", shard=SHARD_INDEX, shards=SHARD_COUNT)
+    try:
+        # по SIGTERM дочитываем то, что процесс приёма уже положил в очередь
+        while True:
+            try:
+                raw = await loop.run_in_executor(None, get)
+            except queue.Empty:
+                if stop.is_set():
+                    break
+                continue
+            if raw is None:
+                break
+            t = asyncio.create_task(dp.feed_raw_update(bot, json.loads(raw)))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await stop_worker(bot)
+        await bot.session.close()
+
+
+def run_shard_worker(updates: "multiprocessing.Queue"):
+    # Ctrl+C приходит всей группе процессов — воркер останавливает процесс приёма
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(shard_worker_main(updates))
+
+
+async def run_sharded(workers: int):
+    """Процесс приёма: long polling или webhook, апдейты раздаются воркерам по user id.
+
+    Воркеры — отдельные процессы (spawn) с BOT_SHARD/BOT_SHARDS в окружении; у каждого
+    свой outbox (строки с его shard), свой bot.shard<i>.log и общий bot.db/STATE.
+    """
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=1000) for _ in range(workers)]
+    state_server = await serve_state(STATE_SOCKET) if STATE_BACKEND == "socket" else None
+
+    procs = []
+    env = dict(os.environ)
+    try:
+        for i, q in enumerate(queues):
+            os.environ.update(BOT_SHARD=str(i), BOT_SHARDS=str(workers))
+            p = ctx.Process(target=run_shard_worker, args=(q,), name=f"bot-shard{i}")
+            p.start()
+            procs.append(p)
+    finally:
+        os.environ.clear()
+        os.environ.update(env)
+
+    loop = asyncio.get_running_loop()
+
+    async def route(update: dict):
+        i = shard_of(update, workers)
+        raw = json.dumps(update, ensure_ascii=False)
+        try:
+            queues[i].put_nowait(raw)
+        except queue.Full:
+            await loop.run_in_executor(None, queues[i].put, raw)
+        METRICS.inc("updates_routed_total", "shard", str(i))
+
+    bot = Bot(BOT_TOKEN, session=SplitSession())
+    bot.session.middleware(API_METRICS)
+    # процессу приёма из БД нужен только meta (хэш команд), схему поднимают воркеры
+    await STORAGE.open()
+    await STORAGE.execute(SQL_META_CREATE)
+    LIFECYCLE.spawn(register_commands(bot))
+    if METRICS_PORT:
+        await start_metrics_server()
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    log_event("bot_started", user=None, chat_id=None, message_id=None, mode=BOT_MODE, workers=workers)
+    runner = None
+    try:
+        if BOT_MODE == "webhook":
+            from aiohttp import web
+
+            async def on_update(request):
+                if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                    return web.Response(status=401)
+                await route(await request.json())
+                return web.Response()
+
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, on_update)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            await stop.wait()
+        else:
+            await bot.delete_webhook()
+            offset = None
+            allowed = dp.resolve_used_update_types()
+            stopping = asyncio.create_task(stop.wait())
+            while not stop.is_set():
+                poll = asyncio.create_task(bot.get_updates(offset=offset, timeout=25, allowed_updates=allowed))
+                await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+                if not poll.done():
+                    poll.cancel()
+                    break
+                try:
+                    updates = poll.result()
+                except Exception as e:
+                    logger.warning("get_updates failed: %r", e)
+                    await asyncio.sleep(1)
+                    continue
+                for u in updates:
+                    offset = u.update_id + 1
+                    await route(u.model_dump(mode="json", by_alias=True, exclude_none=True))
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        for q in queues:
+            q.put(None)
+        for p in procs:
+            await loop.run_in_executor(None, p.join, 30)
+            if p.is_alive():
+                p.terminate()
+        if state_server is not None:
+            state_server.close()
+        await STORAGE.close()
+        await bot.session.close()
+
+
+async def run_state_server():
+    server = await serve_state(STATE_SOCKET)
+    async with server:
+        await server.serve_forever()
+
+
+async def check_startup() -> int:
+    """Замер рестарта по этапам: импорт, БД, шаблоны, бот, команды, первый ответ Telegram.
+
+    Outbox, фоновые задачи и метрики не запускаются, getUpdates не вызывается —
+    long poll живого бота не прерывается. Первый запрос — getMe (в webhook-режиме
+    getWebhookInfo). Побочные эффекты как у обычного старта: миграции bot.db и
+    регистрация команд, если их хэш изменился (параллельно с первым запросом, как в main()).
+    Код возврата 1, если до первого ответа ушло больше STARTUP_BUDGET_MS.
+    """
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN пуст")
+
+    async def measure(coro) -> Tuple[Any, float, str]:
+        t = time.perf_counter()
+        try:
+            result, note = await coro, ""
+        except Exception as e:
+            result, note = None, f"error: {e!r}"
+        return result, time.perf_counter() - t, note
+
+    stages = [("import", time.perf_counter() - _BOOT_T0, "")]
+    t0 = time.perf_counter()
+    await db_init()
+    stages.append(("db_init", time.perf_counter() - t0, ""))
+    t0 = time.perf_counter()
+    load_templates()
+    stages.append(("load_templates", time.perf_counter() - t0, ""))
+    t0 = time.perf_counter()
+    bot = Bot(BOT_TOKEN, session=SplitSession())
+    stages.append(("Bot", time.perf_counter() - t0, ""))
 
-    log_event("bot_started", user=None, chat_id=None, message_id=None)
-    await dp.start_polling(bot)
+    try:
+        first = bot.get_webhook_info() if BOT_MODE == "webhook" else bot.get_me()
+        (sent, t_cmd, cmd_note), (_, t_first, first_note) = await asyncio.gather(
+            measure(setup_commands(bot)), measure(first)
+        )
+        cmd = "commands " + ("sent" if sent else "failed" if cmd_note else "skipped (hash unchanged)")
+        stages.append((cmd, t_cmd, cmd_note))
+        stages.append(("first " + ("getWebhookInfo" if BOT_MODE == "webhook" else "getMe"), t_first, first_note))
+    finally:
+        await STATE.close()
+        await STORAGE.close()
+        await bot.session.close()
+
+    ready = sum(sec for name, sec, _ in stages if not name.startswith("commands"))
+    for name, sec, note in stages:
+        print(f"{name:<36}{sec * 1000:>9.1f} ms  {note}".rstrip())
+    print(f"{'to first API response':<36}{ready * 1000:>9.1f} ms  (budget {STARTUP_BUDGET_MS} ms)")
+    return 0 if ready * 1000 <= STARTUP_BUDGET_MS else 1
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=1, help="число процессов-воркеров (шарды по user id)")
+    ap.add_argument("--state-server", action="store_true", help="только общее хранилище STATE_SOCKET")
+    ap.add_argument("--check-startup", action="store_true", help="замерить время рестарта и выйти")
+    args = ap.parse_args()
+    if args.check_startup:
+        raise SystemExit(asyncio.run(check_startup()))
+    if args.state_server:
+        asyncio.run(run_state_server())
+    elif args.workers > 1:
+        asyncio.run(run_sharded(args.workers))
+    else:
+        asyncio.run(main())